@@ -1,40 +1,528 @@
-from docset.index import Index
-from docset import rules
+from docset.index import Index, RowCollector, apply_delta, DEFAULT_BATCH_SIZE, \
+    DEFAULT_MEMORY_LIMIT
+from docset import fastcopy
+from docset.actions import DEFAULT_PARSE_MEMORY_LIMIT
+from docset.cache import ParseCache, code_fingerprint, DEFAULT_MAX_SIZE as DEFAULT_CACHE_SIZE
+from docset.dedup import dedup
+from docset.links import check_entries, DEFAULT_REPORT_LIMIT as DEFAULT_LINKS_REPORT
+from docset.manifest import Manifest, decode_entry, file_hash
+from docset.schedule import Scheduler, DEFAULT_WINDOW as DEFAULT_QUEUE_SIZE
+from docset.source import DirSource, source_for, sized_files
+from docset import rules, timing
+from collections import Counter
+import hashlib
+import logging as log
+import multiprocessing
 import os
+import resource
 import shutil
 
 
-def build_docset(info, ds_rules, src_dir, out_dir):
+def is_up_to_date(entry, doc_dir, digest):
+    if not entry or entry['hash'] != digest:
+        return False
+    return entry['dest'] is None or \
+        os.path.exists(os.path.join(doc_dir, entry['dest']))
+
+
+def reuse_shared(shared, dest_path, counters):
+    """Takes output of the same page built for another docset,
+    returns its entry or None if it is gone"""
+    (_, shared_doc_dir, data) = shared
+    entry = decode_entry(data)
+    if entry['dest']:
+        rules.ensure_dir(os.path.dirname(dest_path))
+        try:
+            # Outputs are never modified in place, so could be linked
+            fastcopy.copy_file("hardlink", os.path.join(shared_doc_dir, entry['dest']),
+                               dest_path)
+        except (IOError, OSError):
+            return None
+    count(counters, 'shared_pages')
+    return entry
+
+
+def count(counters, key):
+    if counters is not None:
+        counters[key] = counters.get(key, 0) + 1
+
+
+def restore_cached(cached, settings, item, dest_path):
+    """Restores output of a cached page, returns its entry"""
+    (entry, out_path) = cached
+    (_, full_path, data) = item
+    if entry['dest']:
+        rules.ensure_dir(os.path.dirname(dest_path))
+        if out_path:
+            fastcopy.copy_file("hardlink", out_path, dest_path)
+        elif data is None:
+            fastcopy.copy_file(settings['copy'], full_path, dest_path)
+        else:
+            with open(dest_path, "wb") as f:
+                f.write(data)
+    return entry
+
+
+def process_file(ds_rules, settings, item, prev_entry=None, counters=None,
+                 shared=None):
+    """Processes a single source item, returns manifest entry for it.
+    If file wasn't changed since previous build, previous entry
+    is returned as is.
+
+    settings are per build values shared by all files: doc_dir,
+    copy strategy, parse memory limit and parse cache (or None).
+    counters is a dict for per build counters actions increment
+    (see actions.count). shared is (hash, doc_dir, encoded entry) of a
+    page with the same path built for another docset with the
+    same rules, it is reused if hash is the same"""
+    doc_dir = settings['doc_dir']
+    (rel_path, full_path, data) = item
+    with timing.phase("hash"):
+        if data is None:
+            digest = file_hash(full_path)
+        else:
+            digest = hashlib.sha1(data).hexdigest()
+    if is_up_to_date(prev_entry, doc_dir, digest):
+        return prev_entry
+
+    dest_path = os.path.join(doc_dir, rel_path)
+    # Changed file might be not written at all this time. Also it
+    # might be a hard link to source, which shouldn't be overwritten
+    if os.path.lexists(dest_path):
+        os.remove(dest_path)
+
+    if shared and shared[0] == digest:
+        entry = reuse_shared(shared, dest_path, counters)
+        if entry is not None:
+            return entry
+
+    cache = settings.get('cache')
+    if cache:
+        cached = cache.get(digest, rel_path)
+        if cached:
+            count(counters, 'cache_hits')
+            return restore_cached(cached, settings, item, dest_path)
+        count(counters, 'cache_misses')
+
+    collector = RowCollector()
+    ctx = {
+        'src_path': full_path,
+        'src_data': data,
+        'dest_path': dest_path,
+        'rel_path': rel_path,
+        'copy': settings['copy'],
+        'parse_memory_limit': settings['parse_memory_limit'],
+        'counters': counters,
+        'fulltext': settings.get('fulltext', False),
+        'check_links': settings.get('check_links', False),
+        'idx': collector
+    }
+
+    rule = rules.process_file_rules(ds_rules, ctx)
+
+    entry = {
+        'hash': digest,
+        'rule': rule,
+        'rows': collector.rows,
+        'dest': rel_path if os.path.exists(dest_path) else None
+    }
+    if settings.get('fulltext'):
+        entry['texts'] = collector.texts
+    if collector.anchors is not None:
+        entry['anchors'] = collector.anchors
+
+    modified = entry['dest'] and not ctx.get('output_unmodified', False)
+    # Plain copies are cheaper to redo than to cache
+    if cache and (modified or entry['rows']):
+        cache.put(digest, rel_path, entry, dest_path if modified else None)
+    return entry
+
+
+# Rules might contain closures, which can't be pickled,
+# so they're passed to workers once, on pool creation.
+# Pool could be shared by builds, so rules are keyed by
+# docset type and files are sent with settings of their build
+_worker_rules = None
+
+
+def _init_worker(rules_by_type):
+    global _worker_rules
+    _worker_rules = rules_by_type
+    # Profiler might be inherited from the main process
+    timing.enable(None)
+
+
+def _process_in_worker(item):
+    (ty, settings, src_item, prev_entry, shared) = item
+    counters = {}
+    # Builds sharing pool might be profiled or not
+    profiler = timing.Profiler(*settings['profile']) if settings.get('profile') else None
+    timing.enable(profiler)
+    try:
+        entry = process_file(_worker_rules[ty], settings, src_item, prev_entry,
+                             counters, shared)
+    finally:
+        timing.enable(None)
+
+    return (src_item[0], entry, counters,
+            profiler.drain() if profiler else None,)
+
+
+def _process_chunk_in_worker(chunk):
+    """Files are sent to workers in chunks of (seq, item) to
+    reduce IPC overhead"""
+    return [(seq, _process_in_worker(item)) for (seq, item) in chunk]
+
+
+def job_count(info):
+    """Number of worker processes, 0 means one per CPU"""
+    jobs = int(info.get('jobs', 1))
+    if jobs <= 0:
+        jobs = multiprocessing.cpu_count()
+    return jobs
+
+
+def create_pool(jobs, rules_by_type):
+    """Creates worker pool, which could be shared by builds of
+    docsets with given types, even concurrent ones. rules_by_type
+    maps docset type to its rules, jobs=0 means one worker per CPU"""
+    jobs = job_count({'jobs': jobs})
+    rules_by_type = dict((ty, rules.compile_rules(ds_rules))
+                         for (ty, ds_rules) in rules_by_type.items())
+    return multiprocessing.Pool(jobs, _init_worker, (rules_by_type,))
+
+
+def remove_output(doc_dir, rel_path):
+    """Removes output file and its parent dirs if they become empty"""
+    path = os.path.join(doc_dir, rel_path)
+    if os.path.exists(path):
+        os.remove(path)
+
+    dirname = os.path.dirname(path)
+    while dirname != doc_dir and not os.listdir(dirname):
+        os.rmdir(dirname)
+        dirname = os.path.dirname(dirname)
+
+
+def profiler_args(info):
+    """Arguments of Profiler for build or None if it isn't profiled"""
+    if not info.get('profile', False):
+        return None
+    return (int(info.get('profile_slowest', 10)), bool(info.get('profile_trace')),)
+
+
+def make_profiler(info):
+    args = profiler_args(info)
+    return timing.Profiler(*args) if args else None
+
+
+def docset_paths(info, out_dir):
+    """Returns paths of docset parts in out_dir"""
     root_dir = os.path.join(out_dir, info['name'] + '.docset')
     content_dir = os.path.join(root_dir, 'Contents')
     resources_dir = os.path.join(content_dir, 'Resources')
-    doc_dir = os.path.join(resources_dir, 'Documents')
-    index_path = os.path.join(resources_dir, 'docSet.dsidx')
+    return {
+        'root_dir': root_dir,
+        'content_dir': content_dir,
+        'doc_dir': os.path.join(resources_dir, 'Documents'),
+        'index_path': os.path.join(resources_dir, 'docSet.dsidx'),
+        'manifest_path': os.path.join(out_dir, info['name'] + '.manifest.json'),
+    }
+
+
+def rules_id(info, ds_rules):
+    """Identifies what is collected from files, manifest and
+    cache entries are valid only for the same id. Tables from
+    docset.backends are fingerprinted once, other rules on
+    every call"""
+    fingerprint = getattr(ds_rules, 'fingerprint', None) or \
+        code_fingerprint(info.get('type'), ds_rules)
+    return ":".join([fingerprint] + [option for option in ("fulltext", "check_links")
+                                     if info.get(option, False)])
+
+
+def make_settings(info, ds_rules, src_dir, doc_dir):
+    """Returns settings for process_file, src_dir is None
+    if source isn't a directory"""
+    settings = {
+        'doc_dir': doc_dir,
+        'copy': fastcopy.select(info.get('copy', "auto"), src_dir, doc_dir),
+        'parse_memory_limit': int(info.get('parse_memory_limit',
+                                           DEFAULT_PARSE_MEMORY_LIMIT)),
+        'fulltext': bool(info.get('fulltext', False)),
+        'check_links': bool(info.get('check_links', False)),
+        # Workers profile files of this build with these arguments
+        'profile': profiler_args(info),
+        'cache': None
+    }
+    if info.get('cache_dir'):
+        settings['cache'] = ParseCache(info['cache_dir'], rules_id(info, ds_rules),
+                                       int(info.get('cache_size', DEFAULT_CACHE_SIZE)))
+    return settings
+
+
+def build_docset(info, ds_rules, src, out_dir, on_output=None, pool=None,
+                 shared=None):
+    """Builds docset from src, which is either a directory
+    path or a source from docset.source.
+
+    on_output is called with path relative to docset dir for
+    every file of docset as soon as it is complete, i.e. for
+    streaming it into archive.
+
+    Concurrent builds could share pool from create_pool, which
+    knows rules of docset type, and shared, a dict through which
+    builds of the same type reuse results for identical pages.
+    Returns build stats as a dict"""
+    paths = docset_paths(info, out_dir)
+    root_dir = paths['root_dir']
+    content_dir = paths['content_dir']
+    doc_dir = paths['doc_dir']
+    index_path = paths['index_path']
+    manifest_path = paths['manifest_path']
 
     if not os.path.exists(doc_dir):
         os.makedirs(doc_dir)
 
+    def emit(path):
+        if on_output:
+            on_output(os.path.relpath(path, root_dir))
+
     with open(os.path.join(content_dir, "Info.plist"), "w+t") as f:
         f.write(info['plist'])
+    emit(os.path.join(content_dir, "Info.plist"))
 
     if 'icon' in info and os.path.exists(info['icon']):
         shutil.copy2(info['icon'], root_dir)
+        emit(os.path.join(root_dir, os.path.basename(info['icon'])))
+
+    ds_rules = rules.compile_rules(ds_rules)
+    prev = Manifest(manifest_path, rules_id(info, ds_rules))
+    if info.get('incremental', False):
+        prev.load()
+    manifest = Manifest(manifest_path, prev.fingerprint)
+
+    # Index is always rebuilt, but rows of unchanged
+    # files are taken from manifest
+    hits = [0] * len(ds_rules)
+
+    profiler = make_profiler(info)
+    timing.enable(profiler)
+
+    idx = Index(index_path,
+                int(info.get('index_batch_size', DEFAULT_BATCH_SIZE)),
+                int(info.get('index_memory_limit', DEFAULT_MEMORY_LIMIT)),
+                bool(info.get('fulltext', False)),
+                bool(info.get('query_index', False)))
+    jobs = job_count(info)
+
+    source = source_for(src)
+    settings = make_settings(info, ds_rules, getattr(source, 'path', None), doc_dir)
+
+    ty = info.get('type')
+
+    def work_item(src_item):
+        return (ty, settings, src_item, prev.entries.get(src_item[0]),
+                shared.get((ty, src_item[0],)) if shared is not None else None,)
+
+    counters = {}
+
+    def merge_counters(file_counters):
+        for (key, value) in file_counters.items():
+            counters[key] = counters.get(key, 0) + value
+
+    def on_result(rel_path, entry):
+        manifest.entries[rel_path] = entry
+        idx.extend(entry['rows'])
+        idx.extend_texts(entry.get('texts', ()))
+        if entry['dest']:
+            emit(os.path.join(doc_dir, entry['dest']))
+        if entry['rule'] is not None:
+            hits[entry['rule']] += 1
+        if shared is not None:
+            shared[(ty, rel_path,)] = (entry['hash'], doc_dir,
+                                       manifest.entries.raw(rel_path),)
+
+    queue_peak = None
+    if jobs == 1 and pool is None:
+        # Sizes are needed only to schedule files for workers
+        for (_, _, src_item, prev_entry, shared_entry) in \
+                (work_item(src_item) for src_item in source.files()):
+            on_result(src_item[0], process_file(ds_rules, settings, src_item,
+                                                prev_entry, counters, shared_entry))
+    else:
+        # Workers only process files, biggest first, index is
+        # written here in source order, so it stays deterministic
+        own_pool = pool is None
+        if own_pool:
+            pool = create_pool(jobs, {ty: ds_rules})
+        scheduler = Scheduler(((size, work_item(src_item),)
+                               for (size, src_item) in sized_files(source)),
+                              int(info.get('queue_size', DEFAULT_QUEUE_SIZE)))
+        try:
+            for (rel_path, entry, file_counters, profile) in \
+                    scheduler.results(pool, _process_chunk_in_worker):
+                on_result(rel_path, entry)
+                merge_counters(file_counters)
+                if profile and profiler:
+                    profiler.merge(profile)
+            if own_pool:
+                pool.close()
+        except:
+            if own_pool:
+                pool.terminate()
+            raise
+        finally:
+            if own_pool:
+                pool.join()
+        queue_peak = scheduler.peak_pending
+
+    # Files which are gone since previous build
+    for rel_path in prev.entries:
+        if rel_path not in manifest.entries:
+            entry = prev.entries[rel_path]
+            if entry['dest']:
+                remove_output(doc_dir, entry['dest'])
+
+    stats = {'index': idx.flush(), 'copy': settings['copy'],
+             'counters': counters}
+    if queue_peak is not None:
+        stats['queue_peak'] = queue_peak
+    emit(index_path)
+    if info.get('dedup', True):
+        outputs = [entry['dest'] for entry in manifest.entries.values()
+                   if entry['dest']]
+        stats['dedup'] = dedup(doc_dir, outputs)
+    if settings['cache']:
+        stats['cache'] = settings['cache'].prune()
+    if settings['check_links']:
+        with timing.phase("links.check"):
+            stats['links'] = check_entries(manifest.entries,
+                                           int(info.get('links_report', DEFAULT_LINKS_REPORT)))
+    if info.get('debug_rules', False):
+        stats['rules'] = ds_rules.report(hits)
+
+    if profiler:
+        timing.enable(None)
+        stats['profile'] = profiler.summary()
+        if info.get('profile_trace'):
+            profiler.save_trace(info['profile_trace'])
+    manifest.save()
+    # Peak of the whole process, in KB, it includes everything
+    # build keeps besides the index buffer
+    stats['peak_rss'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return stats
+
+
+def row_key(row):
+    """Rows from manifest are unicode, fresh ones might be utf-8"""
+    return tuple(s.decode("utf-8") if isinstance(s, str) else s for s in row)
+
+
+class LiveDocset(object):
+    """Docset already built from src_dir into out_dir, which is
+    updated in place as source files change: changed files are
+    processed again and only rows which appeared or disappeared
+    are written to index. Docset should be built with the same
+    info before, as its manifest is a starting point"""
+    def __init__(self, info, ds_rules, src_dir, out_dir):
+        self.src_dir = src_dir
+        self.paths = docset_paths(info, out_dir)
+        self.ds_rules = rules.compile_rules(ds_rules)
+        self.manifest = Manifest(self.paths['manifest_path'],
+                                 rules_id(info, self.ds_rules)).load()
+        self.settings = make_settings(info, self.ds_rules, src_dir,
+                                      self.paths['doc_dir'])
+        # The same row could be emitted by several files,
+        # it is in index while any of them emits it
+        self._row_refs = Counter()
+        for entry in self.manifest.entries.values():
+            self._row_refs.update(row_key(row) for row in entry['rows'])
+
+    def _affected(self, changes):
+        """Paths of source files and manifest entries under changed
+        paths, None means everything"""
+        if changes is None or os.curdir in changes:
+            changes = [os.curdir]
+
+        affected = set()
+        for change in changes:
+            if change == os.curdir:
+                affected.update(self.manifest.entries)
+            else:
+                prefix = change + os.sep
+                affected.update(rel_path for rel_path in self.manifest.entries
+                                if rel_path == change or rel_path.startswith(prefix))
+
+            full_path = os.path.join(self.src_dir, change)
+            if os.path.isdir(full_path):
+                affected.update(os.path.relpath(item[1], self.src_dir)
+                                for item in DirSource(full_path).files())
+            elif os.path.isfile(full_path):
+                affected.add(os.path.normpath(change))
+        return sorted(affected)
+
+    def update(self, changes):
+        """Applies changes, which are paths relative to src_dir of
+        changed, added or removed files or dirs, or None if anything
+        might be changed. Returns stats"""
+        doc_dir = self.paths['doc_dir']
+        counters = {}
+        before = Counter()
+        after = Counter()
+        # Texts are replaced by page
+        removed_texts = []
+        added_texts = []
+        affected = self._affected(changes)
+        for rel_path in affected:
+            prev_entry = self.manifest.entries.get(rel_path)
+            if prev_entry:
+                before.update(row_key(row) for row in prev_entry['rows'])
 
-    idx = Index(index_path)
+            full_path = os.path.join(self.src_dir, rel_path)
+            if not os.path.isfile(full_path):
+                if prev_entry:
+                    removed_texts.extend(text[0] for text in prev_entry.get('texts', ()))
+                    del self.manifest.entries[rel_path]
+                    if prev_entry['dest']:
+                        remove_output(doc_dir, prev_entry['dest'])
+                continue
 
-    for root, dirnames, filenames in os.walk(src_dir):
-        for filename in filenames:
-            full_path = os.path.join(root, filename)
-            rel_path = os.path.relpath(full_path, src_dir)
-            dest_path = os.path.join(doc_dir, rel_path)
+            try:
+                entry = process_file(self.ds_rules, self.settings,
+                                     (rel_path, full_path, None,), prev_entry, counters)
+            except (IOError, OSError) as e:
+                # File could be rewritten or removed while cargo runs,
+                # next batch will have it again
+                log.warn("Can't update %s: %s", rel_path, e)
+                if prev_entry:
+                    after.update(row_key(row) for row in prev_entry['rows'])
+                continue
+            self.manifest.entries[rel_path] = entry
+            after.update(row_key(row) for row in entry['rows'])
+            if entry is not prev_entry:
+                removed_texts.extend(text[0] for text in
+                                     (prev_entry or {}).get('texts', ()))
+                added_texts.extend(entry.get('texts', ()))
 
-            ctx = {
-                'src_path': full_path,
-                'dest_path': dest_path,
-                'rel_path': rel_path,
-                'idx': idx
-            }
+        removed = []
+        added = []
+        for row in set(before) | set(after):
+            refs = self._row_refs[row]
+            new_refs = refs - before[row] + after[row]
+            if refs > 0 and new_refs <= 0:
+                removed.append(row)
+            elif refs <= 0 and new_refs > 0:
+                added.append(row)
+            if new_refs > 0:
+                self._row_refs[row] = new_refs
+            else:
+                del self._row_refs[row]
 
-            rules.process_file_rules(ds_rules, ctx)
+        with timing.phase("sqlite.delta"):
+            apply_delta(self.paths['index_path'], removed, added,
+                        removed_texts, added_texts)
+        self.manifest.save()
+        return {'files': len(affected), 'added': len(added),
+                'removed': len(removed), 'counters': counters}
 
-    idx.flush()
@@ -1 +1,32 @@
-from builder import build_docset
+import importlib
+import sys
+from types import ModuleType
+
+"""Build API is loaded on first use, so modules which don't need
+lxml and sqlite (i.e. docset.fetch for a check of nightly updates)
+are imported without paying for them"""
+
+# Public name -> module it is loaded from
+LAZY_NAMES = {
+    'build_docset': "builder",
+    'create_pool': "builder",
+    'LiveDocset': "builder",
+}
+
+
+class LazyModule(ModuleType):
+    def __getattr__(self, name):
+        module = LAZY_NAMES.get(name)
+        if module is None:
+            raise AttributeError("module %s has no attribute %s" % (self.__name__, name,))
+        value = getattr(importlib.import_module(module), name)
+        setattr(self, name, value)
+        return value
+
+
+_lazy = LazyModule(__name__, __doc__)
+_lazy.__dict__.update(sys.modules[__name__].__dict__)
+# Globals of this module are used by LazyModule, so
+# the original one is kept alive
+_lazy._module = sys.modules[__name__]
+sys.modules[__name__] = _lazy
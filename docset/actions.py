@@ -1,51 +1,178 @@
+from functools import wraps
+from io import BytesIO
+from extract import Extractor, could_match, stream_nodes, streamable
+import fastcopy
+from fulltext import page_text
+from links import scan_anchors, tree_anchors
 import logging as log
 from lxml import html
 import os
 import scrape
-import shutil
+import timing
 from toc import inject_toc
 
 
+# Pages bigger than this are parsed without building a tree,
+# if it is possible
+DEFAULT_PARSE_MEMORY_LIMIT = 1024*1024
+
+
+def read_source(ctx):
+    """Returns source contents, either already read or from disk"""
+    data = ctx.get('src_data')
+    if data is None:
+        with open(ctx['src_path'], 'rb') as f:
+            data = f.read()
+    return data
+
+
 def cp_file(ctx):
-    """Copies file"""
-    shutil.copy2(ctx['src_path'], ctx['dest_path'])
+    """Copies file with strategy selected for build"""
+    ctx['output_unmodified'] = True
+    with timing.phase("copy"):
+        data = ctx.get('src_data')
+        if data is None:
+            fastcopy.copy_file(ctx.get('copy', "copy"),
+                               ctx['src_path'], ctx['dest_path'])
+        else:
+            with open(ctx['dest_path'], 'wb') as f:
+                f.write(data)
 
 
 def patch_file(patch_func):
     """Applies patch_func to file context and stores new content"""
     def closure(ctx):
-        contents = patch_func(open(ctx['src_path'], 'rt').read())
-        with open(ctx['dest_path'], 'wt') as f:
-            f.write(contents)
+        with timing.phase("patch"):
+            contents = patch_func(read_source(ctx))
+            with open(ctx['dest_path'], 'wt') as f:
+                f.write(contents)
 
+    closure.__name__ = "patch_file"
     return closure
 
 
+def write_unmodified(ctx, data):
+    """Stores already read source as is. Links and clones
+    are still cheaper than writing, so they are used if
+    possible"""
+    if ctx.get('src_path') and ctx.get('copy') in fastcopy.NO_DATA_STRATEGIES:
+        cp_file(ctx)
+    else:
+        ctx['output_unmodified'] = True
+        with timing.phase("copy"):
+            with open(ctx['dest_path'], 'wb') as f:
+                f.write(data)
+
+
+def count(ctx, key):
+    """Increments per build counter"""
+    counters = ctx.get('counters')
+    if counters is not None:
+        counters[key] = counters.get(key, 0) + 1
+
+
 def update_toc(ctx, tree, rules, ty_map_fn = None):
     """Runs TOC rules over tree, updates html_modification flag"""
     ctx['html_modified'] = ctx['html_modified'] or inject_toc(tree, rules, ty_map_fn)
 
 
+def collect_anchors(ctx, tree, data):
+    """Adds anchors of page to index if links are checked"""
+    if ctx.get('check_links', False):
+        with timing.phase("links.collect"):
+            anchors = tree_anchors(tree) if tree is not None else scan_anchors(data)
+        ctx['idx'].set_anchors(anchors)
+
+
 # FIXME: so far caching isn't actually used fully
 # but it might be useful later on with more atomic
 # actions
-def cached_html(f):
+def cached_html(f=None, filters=None):
     """Wraps a function f(ctx, tree) to process a cached
     version of HTML. If tree is modified - new tree is saved,
-    Otherwise it simply copies file"""
+    Otherwise it simply copies file.
+
+    filters is an optional fn(ctx) which returns a pair of
+    (index filters, TOC filters) f is going to use. If provided,
+    f gets an Extractor, which evaluates all of them at once,
+    instead of tree. Could be used as @cached_html(filters=fn).
+    Also if none of filters could match (see extract.could_match)
+    HTML isn't parsed at all and f gets an empty Extractor.
+
+    Pages bigger than ctx['parse_memory_limit'] are streamed (see
+    extract.stream_nodes) instead of being parsed into a tree, if
+    no TOC filter could match and index filters are streamable.
+
+    If ctx['fulltext'] is set, every page is parsed and its text
+    is added to index, so there is no skipping and streaming.
+
+    If ctx['check_links'] is set, anchors and links of page are
+    collected for docset.links, pages which aren't parsed are
+    scanned for them"""
+    if f is None:
+        return lambda f: cached_html(f, filters)
+
+    @wraps(f)
     def closure(ctx):
+        data = read_source(ctx)
         has_html = ctx.get('has_html', False)
+        # Text is taken from tree
+        needs_tree = ctx.get('fulltext', False)
+
+        flt_list = None
+        if filters:
+            (index_filters, toc_filters) = filters(ctx)
+            flt_list = index_filters + toc_filters
+
+            if not has_html and not needs_tree and not could_match(data, flt_list):
+                # Nothing to scrape or inject, so there is
+                # no need to parse it at all
+                count(ctx, 'skipped_parses')
+                ctx['html_modified'] = False
+                if data.strip():
+                    f(ctx, Extractor(None, flt_list))
+                collect_anchors(ctx, None, data)
+                write_unmodified(ctx, data)
+                return
+
+            limit = ctx.get('parse_memory_limit', DEFAULT_PARSE_MEMORY_LIMIT)
+            if not has_html and not needs_tree and len(data) > limit:
+                if streamable(index_filters) and not could_match(data, toc_filters):
+                    count(ctx, 'streamed_parses')
+                    ctx['html_modified'] = False
+                    f(ctx, Extractor(None, flt_list, stream_nodes(data, index_filters)))
+                    collect_anchors(ctx, None, data)
+                    write_unmodified(ctx, data)
+                    return
+                log.info("%s is bigger than parse memory limit, but needs a tree",
+                         ctx['rel_path'])
+
         if not has_html:
-            tree = html.parse(ctx['src_path'])
+            with timing.phase("html.parse"):
+                tree = html.parse(BytesIO(data))
+            count(ctx, 'parses')
             ctx['has_html'] = True
             ctx['html'] = tree
             ctx['html_modified'] = False
+            if needs_tree and tree.getroot() is not None:
+                with timing.phase("fulltext.extract"):
+                    (title, body) = page_text(tree)
+                ctx['idx'].add_text(ctx['rel_path'], title, body)
+        else:
+            tree = ctx['html']
+
         if tree.getroot() is not None:
-            f(ctx, tree)
+            if flt_list is not None:
+                f(ctx, Extractor(tree, flt_list))
+            else:
+                f(ctx, tree)
+            # TOC anchors are already injected
+            collect_anchors(ctx, tree, data)
 
         if ctx['html_modified']:
-            tree.write(ctx['dest_path'], method="html")
+            with timing.phase("tree.write"):
+                tree.write(ctx['dest_path'], method="html")
         else:
-            cp_file(ctx) # FIXME: should it actually be copied?
+            write_unmodified(ctx, data)
 
     return closure
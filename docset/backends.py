@@ -0,0 +1,114 @@
+from cache import code_fingerprint
+import importlib
+import rules
+import threading
+
+"""Registry of docset backends, i.e. rule sets selected by docset
+type.
+
+Type is "module:attr" (attr defaults to "default"), i.e.
+"docset.rust:nightly" is RUST_STD_RULES exported by docset.rust as
+nightly, or a name registered with register. Backend is imported
+only when its type is used, its rules are validated and compiled
+into a RuleTable and fingerprinted once per process, so builds of
+the same type (several channels, watch updates) and forked workers
+reuse them. Tables are pickled by type name, so they could be sent
+to processes which don't share memory"""
+
+# Registered name -> type
+_aliases = {}
+
+# Type -> Backend
+_backends = {}
+
+_lock = threading.Lock()
+
+
+class BackendError(ValueError):
+    pass
+
+
+def register(name, ty):
+    """Registers name for type, i.e. register("mybook", "mypkg.rules:book")
+    makes type = "mybook" use rules mypkg.rules.book"""
+    _aliases[name] = ty
+
+
+def validate_rules(rules_list, ty):
+    """Raises BackendError if rules_list isn't a list of rules
+    [predicate, ..., action], where predicates are callables and
+    action is a callable or None"""
+    if not isinstance(rules_list, (list, tuple)) or not rules_list:
+        raise BackendError("Rules of %s should be a non-empty list" % ty)
+
+    for (i, rule) in enumerate(rules_list):
+        if not isinstance(rule, (list, tuple)) or not rule:
+            raise BackendError("Rule %d of %s should be a non-empty list" % (i, ty,))
+        if rule[-1] is not None and not callable(rule[-1]):
+            raise BackendError("Action of rule %d of %s isn't callable: %r" %
+                               (i, ty, rule[-1],))
+        for pred in rule[:-1]:
+            if not callable(pred):
+                raise BackendError("Predicate of rule %d of %s isn't callable: %r" %
+                                   (i, ty, pred,))
+
+
+class Backend(object):
+    """Rule set of a docset type, loaded on first use"""
+    def __init__(self, ty):
+        self.ty = ty
+        parts = _aliases.get(ty, ty).split(":")
+        if len(parts) == 1:
+            parts.append("default")
+        (self.module_name, self.attr) = parts
+        self._table = None
+        self._fingerprint = None
+
+    @property
+    def rules(self):
+        try:
+            module = importlib.import_module(self.module_name)
+        except ImportError as e:
+            raise BackendError("Failed to import docset type specs: %s (%s)" %
+                               (self.module_name, e,))
+        rules_list = getattr(module, self.attr, None)
+        if rules_list is None:
+            raise BackendError("%s has no rules %s" % (self.module_name, self.attr,))
+        return rules_list
+
+    @property
+    def table(self):
+        if self._table is None:
+            rules_list = self.rules
+            validate_rules(rules_list, self.ty)
+            table = rules.compile_rules(rules_list)
+            table.backend = self.ty
+            table.fingerprint = self.fingerprint
+            self._table = table
+        return self._table
+
+    @property
+    def fingerprint(self):
+        """Fingerprint of rules and code which runs them"""
+        if self._fingerprint is None:
+            self._fingerprint = code_fingerprint(self.ty, self.rules, [self.module_name])
+        return self._fingerprint
+
+
+def get(ty):
+    """Returns backend of docset type, raises BackendError
+    if it can't be loaded"""
+    with _lock:
+        backend = _backends.get(ty)
+        if backend is None:
+            backend = Backend(ty)
+            # Loaded before it is registered, so a broken
+            # backend isn't cached
+            backend.table
+            _backends[ty] = backend
+    return backend
+
+
+def table_for(ty):
+    """Compiled rules of type, used to unpickle RuleTable"""
+    return get(ty).table
@@ -0,0 +1,324 @@
+from builder import docset_paths
+from docset import build_docset
+import fulltext
+import json
+import logging as log
+import os
+import pickle
+import random
+import resource
+import shutil
+import sqlite3
+import subprocess
+import sys
+import tempfile
+import time
+import timing
+
+"""Synthetic rustdoc corpus and build benchmark.
+
+Corpus mimics layout and markup rustdoc generates for std, which
+is matched by docset.rust rules: crates with nested modules,
+struct/enum/trait/type/fn pages, guides, book, sources and
+static assets. It is fully determined by its parameters"""
+
+WORDS = ("the a value returns an iterator over slice of elements which "
+         "is used to create new collection from given index and panics "
+         "if out bounds this method consumes self reference mutable "
+         "buffer length capacity memory allocation thread safe").split()
+
+PAGE = """<!DOCTYPE html>
+<html lang="en">
+<head>
+    <meta charset="utf-8">
+    <title>%(title)s</title>
+    <link rel="stylesheet" type="text/css" href="%(root)smain.css">
+</head>
+<body class="rustdoc">
+    <section class="sidebar"><p class="location">%(title)s</p></section>
+    <nav class="sub"><form class="search-form"><input class="search-input"></form></nav>
+    <section id="main" class="content">
+%(body)s
+    </section>
+    <script src="%(root)sjquery.js"></script>
+    <script src="%(root)smain.js"></script>
+</body>
+</html>
+"""
+
+GUIDE = """<!DOCTYPE html>
+<html lang="en">
+<head><meta charset="utf-8"><title>%(title)s</title></head>
+<body class="rustdoc">
+<h1 class="title">%(title)s</h1>
+%(body)s
+</body>
+</html>
+"""
+
+
+# Full-text queries: words, phrases, prefixes and Rust paths of corpus
+FULLTEXT_QUERIES = ["iterator", "memory allocation", "returns an iterator",
+                    "thread safe", "capac*", "fn", "core::marker::Clone",
+                    "panics if out bounds"]
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs a build in run_in_child
+CHILD_CODE = ("import sys; sys.path.insert(0, %r); from docset import bench; "
+              "bench.run_child(sys.argv[1], sys.argv[2])" % ROOT_DIR)
+
+
+class Corpus(object):
+    def __init__(self, root, crates, modules, items, seed):
+        self.root = root
+        self.crates = crates
+        self.modules = modules
+        self.items = items
+        self.rnd = random.Random(seed)
+        self.files = 0
+        self.bytes = 0
+
+    def write(self, rel_path, data):
+        path = os.path.join(self.root, rel_path)
+        dirname = os.path.dirname(path)
+        if not os.path.exists(dirname):
+            os.makedirs(dirname)
+        with open(path, "wb") as f:
+            f.write(data)
+        self.files += 1
+        self.bytes += len(data)
+
+    def text(self, words):
+        return " ".join(self.rnd.choice(WORDS) for _ in range(words))
+
+    def docblock(self):
+        return '<div class="docblock"><p>%s</p></div>' % self.text(self.rnd.randint(10, 60))
+
+    def page(self, rel_path, title, body):
+        root = "../" * rel_path.count("/")
+        self.write(rel_path, PAGE % {'title': title, 'root': root, 'body': body})
+
+    def method(self, prefix, name):
+        return '<h4 id="%s.%s" class="method"><code>fn %s(&amp;self)</code></h4>%s' % \
+            (prefix, name, name, self.docblock())
+
+    def trait_impls(self, ty, name):
+        impls = []
+        for trait in self.rnd.sample(["Clone", "Debug", "Default", "Eq", "Hash", "Drop"], 3):
+            impls.append('<h3 class="impl"><code>impl <a class="trait" href="#" '
+                         'title="core::marker::%s">%s</a> for <a class="%s">%s</a></code></h3>' %
+                         (trait, trait, ty, name))
+        return "\n".join(impls)
+
+    def struct(self, path, fqn, name):
+        fields = "".join('<tr><td id="structfield.f%d"><code>f%d</code></td><td>%s</td></tr>' %
+                         (i, i, self.text(8)) for i in range(self.rnd.randint(0, 5)))
+        methods = "\n".join(self.method("method", "m%d" % i)
+                            for i in range(self.rnd.randint(1, 12)))
+        body = ('<h1 class="fqn">Struct %s</h1>%s'
+                '<h2 class="fields">Fields</h2><table>%s</table>\n'
+                '<h2 id="methods">Methods</h2>%s\n%s') % \
+            (fqn, self.docblock(), fields, methods, self.trait_impls("struct", name))
+        self.page(path + "/struct.%s.html" % name, name, body)
+
+    def enum(self, path, fqn, name):
+        variants = "".join('<tr><td id="variant.V%d"><span id="variant.V%d" class="variant">'
+                           '<span><code>V%d</code></span></span></td><td>%s</td></tr>' %
+                           (i, i, i, self.text(6)) for i in range(self.rnd.randint(1, 8)))
+        methods = "\n".join(self.method("method", "e%d" % i)
+                            for i in range(self.rnd.randint(0, 4)))
+        body = ('<h1 class="fqn">Enum %s</h1>%s'
+                '<h2 class="variants">Variants</h2><table>%s</table>\n%s\n%s') % \
+            (fqn, self.docblock(), variants, methods, self.trait_impls("enum", name))
+        self.page(path + "/enum.%s.html" % name, name, body)
+
+    def trait(self, path, fqn, name):
+        methods = "\n".join(self.method("tymethod", "t%d" % i) for i in range(self.rnd.randint(1, 4)))
+        provided = "\n".join(self.method("method", "p%d" % i) for i in range(self.rnd.randint(0, 20)))
+        body = '<h1 class="fqn">Trait %s</h1>%s\n%s\n%s' % (fqn, self.docblock(), methods, provided)
+        self.page(path + "/trait.%s.html" % name, name, body)
+
+    def simple(self, path, kind, fqn, name):
+        body = '<h1 class="fqn">%s %s</h1>%s' % (kind, fqn, self.docblock())
+        self.page(path + "/%s.%s.html" % (kind.lower(), name), name, body)
+
+    def module(self, path, submodules):
+        fqn = path.replace("/", "::")
+        sections = []
+        kinds = [("Struct", "struct"), ("Enum", "enum"), ("Trait", "trait"),
+                 ("Type", "type"), ("Fn", "fn")]
+        rows = dict((kind, []) for (_, kind) in kinds)
+
+        for i in range(self.items):
+            (kind_name, kind) = self.rnd.choice(kinds)
+            name = "%s%d" % (kind_name, i)
+            rows[kind].append('<tr><td><a class="%s" href="%s.%s.html">%s</a></td><td>%s</td></tr>' %
+                              (kind, kind, name, name, self.text(6)))
+            if kind == "struct":
+                self.struct(path, fqn + "::" + name, name)
+            elif kind == "enum":
+                self.enum(path, fqn + "::" + name, name)
+            elif kind == "trait":
+                self.trait(path, fqn + "::" + name, name)
+            else:
+                self.simple(path, kind_name, fqn + "::" + name, name)
+
+            src = "src/%s/%s.rs.html" % (path, name.lower())
+            self.page(src, name, "<pre>%s</pre>" % "\n".join(self.text(12) for _ in range(40)))
+
+        if submodules:
+            sections.append('<h2 id="modules">Modules</h2><table>%s</table>' %
+                            "".join('<tr><td><a class="mod" href="%s/index.html">%s</a></td></tr>' %
+                                    (m, m) for m in submodules))
+
+        sections.append('<h2 id="statics">Statics</h2><table><tr><td><code>pub static MAX: u32</code></td></tr></table>')
+        for (kind_name, kind) in kinds:
+            if rows[kind]:
+                sections.append('<h2 id="%ss">%ss</h2><table>%s</table>' %
+                                (kind, kind_name, "".join(rows[kind])))
+
+        body = '<h1 class="fqn">Module %s</h1>%s\n%s' % (fqn, self.docblock(), "\n".join(sections))
+        self.page(path + "/index.html", fqn, body)
+
+    def generate(self):
+        self.write("main.css", "body { font-family: sans-serif; }\n" * 200)
+        self.write("jquery.js", "/* jquery */\n" + "var x = 1;\n" * 5000)
+        self.write("main.js", "/* rustdoc */\n" + "var y = 2;\n" * 1000)
+        self.write("FiraSans-Regular.woff", "".join(chr(self.rnd.randint(0, 255)) for _ in range(40000)))
+        self.write("search-index.js", "var searchIndex = {};\n" * 100)
+
+        for name in ["The Rust Guide", "The Rust Reference", "The Rust Testing Guide"]:
+            rel_path = name.lower().replace(" ", "-") + ".html"
+            self.write(rel_path, GUIDE % {'title': name,
+                                          'body': "\n".join(self.docblock() for _ in range(50))})
+        self.write("index.html", GUIDE % {'title': "Rust Documentation", 'body': self.docblock()})
+
+        self.write("book/index.html", GUIDE % {'title': "The Rust Programming Language",
+                                               'body': self.docblock()})
+        for i in range(10):
+            self.write("book/chapter-%d.html" % i, GUIDE % {'title': "Chapter %d" % i,
+                                                            'body': "\n".join(self.docblock() for _ in range(30))})
+
+        for c in range(self.crates):
+            crate = "crate%d" % c
+            mods = ["mod%d" % m for m in range(self.modules)]
+            self.module(crate, mods)
+            for m in mods:
+                self.module(crate + "/" + m, [])
+        return self
+
+
+def generate_corpus(root, crates=4, modules=4, items=8, seed=1):
+    """Generates corpus into root, returns Corpus with stats"""
+    return Corpus(root, crates, modules, items, seed).generate()
+
+
+def git_revision():
+    try:
+        with open(os.devnull, "w") as devnull:
+            return subprocess.check_output(["git", "rev-parse", "HEAD"],
+                                           stderr=devnull).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def fulltext_latency(index_path, repeat=20):
+    """Runs FULLTEXT_QUERIES repeat times, returns latency stats"""
+    conn = sqlite3.connect(index_path)
+    try:
+        times = []
+        for _ in range(repeat):
+            for query in FULLTEXT_QUERIES:
+                start = time.time()
+                fulltext.search(conn, query)
+                times.append((time.time() - start) * 1000.0)
+        pages = conn.execute("SELECT COUNT(*) FROM searchText;").fetchone()[0]
+    finally:
+        conn.close()
+    return {'pages': pages, 'queries': len(times),
+            'p50_ms': timing.percentile(times, 50), 'p99_ms': timing.percentile(times, 99)}
+
+
+def run_once(info, ds_rules, src_dir, files):
+    """Builds docset from src_dir into a temp dir once"""
+    out_dir = tempfile.mkdtemp(prefix="docset-bench-out")
+    try:
+        start = time.time()
+        stats = build_docset(info, ds_rules, src_dir, out_dir)
+        wall_time = time.time() - start
+        run = {
+            'wall_time': wall_time,
+            'files_per_sec': files / wall_time if wall_time else 0.0,
+            'index_rows': stats['index']['rows'],
+            'stats': stats,
+        }
+        if info.get('fulltext'):
+            run['fulltext'] = fulltext_latency(
+                docset_paths(info, out_dir)['index_path'])
+    finally:
+        shutil.rmtree(out_dir)
+
+    # ru_maxrss is in KB on Linux
+    run['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    run['peak_children_rss_kb'] = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+    return run
+
+
+def run_child(args_path, run_path):
+    """Entry point of a child process of run_in_child"""
+    with open(args_path, "rb") as f:
+        (info, ds_rules, src_dir, files, level) = pickle.load(f)
+    log.basicConfig(level=level)
+    run = run_once(info, ds_rules, src_dir, files)
+    with open(run_path, "wb") as f:
+        pickle.dump(run, f, pickle.HIGHEST_PROTOCOL)
+
+
+def run_in_child(info, ds_rules, src_dir, files):
+    """run_once in a new interpreter, so peak RSS is of the build
+    only, not of corpus generation or earlier runs. Forked process
+    would start with RSS of this one"""
+    temp_dir = tempfile.mkdtemp(prefix="docset-bench-run")
+    try:
+        args_path = os.path.join(temp_dir, "args.pickle")
+        run_path = os.path.join(temp_dir, "run.pickle")
+        with open(args_path, "wb") as f:
+            pickle.dump((info, ds_rules, src_dir, files, log.getLogger().getEffectiveLevel(),),
+                        f, pickle.HIGHEST_PROTOCOL)
+        subprocess.check_call([sys.executable, "-c", CHILD_CODE, args_path, run_path])
+        with open(run_path, "rb") as f:
+            return pickle.load(f)
+    finally:
+        shutil.rmtree(temp_dir)
+
+
+def run_bench(info, ds_rules, src_dir, repeat=1):
+    """Builds docset from src_dir repeat times, every time in a new
+    process, returns results of the fastest run. info is a [docset]
+    config without name/plist. If it enables fulltext, query latency
+    is measured as well"""
+    info = dict(info)
+    info.setdefault('name', "Bench")
+    info.setdefault('plist', "")
+
+    files = 0
+    for root, dirnames, filenames in os.walk(src_dir):
+        files += len(filenames)
+
+    runs = [run_in_child(info, ds_rules, src_dir, files) for _ in range(max(1, repeat))]
+
+    best = min(runs, key=lambda r: r['wall_time'])
+    result = dict(best)
+    result.update({
+        'jobs': info.get('jobs', 1),
+        'files': files,
+        'wall_times': [r['wall_time'] for r in runs],
+        'revision': git_revision(),
+    })
+    return result
+
+
+def save_result(result, path):
+    with open(path, "wt") as f:
+        json.dump(result, f, indent=2, sort_keys=True)
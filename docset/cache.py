@@ -0,0 +1,188 @@
+import fastcopy
+import hashlib
+import importlib
+import json
+import logging as log
+import os
+import sys
+import time
+import timing
+import types
+
+"""Persistent cache of processed pages, shared by builds.
+
+Entry is keyed by source hash, path (FQNs depend on it) and
+fingerprint of code which processes files, and contains matched
+rule, index rows and, if output differs from source, the output
+itself. So when out_dir is wiped or is a fresh one, only pages
+which were changed are processed again.
+
+Entries are files, so workers use cache without any coordination.
+Size of cache is bounded, least recently used entries are evicted
+after build"""
+
+DEFAULT_MAX_SIZE = 1024*1024*1024
+
+DOCSET_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# Modules, which run rules, the rest is found from their imports
+PIPELINE_MODULES = ["builder", "docset.rules", "docset.actions"]
+
+ROOT_DIR = os.path.dirname(DOCSET_DIR)
+
+
+def _module_of(value):
+    if isinstance(value, types.ModuleType):
+        return value
+    try:
+        return sys.modules.get(getattr(value, '__module__', None))
+    except Exception:
+        return None
+
+
+def _is_project(module):
+    path = getattr(module, '__file__', None)
+    if not path:
+        return False
+    path = os.path.abspath(path)
+    return path.startswith(ROOT_DIR + os.sep) and "site-packages" not in path
+
+
+def source_files(ds_rules, modules=()):
+    """Files with code which affects results of rules: builder,
+    modules with rules, modules of predicates and actions and
+    project modules they import, found from names they hold. So
+    changes of modules which aren't used to process pages (delta,
+    bench, query, which index imports lazily) keep caches. Rules
+    are lists, so a package in modules is taken as a whole"""
+    todo = [importlib.import_module(name) for name in PIPELINE_MODULES]
+    paths = set()
+    for name in modules:
+        module = importlib.import_module(name)
+        todo.append(module)
+        if hasattr(module, '__path__') and _is_project(module):
+            for root, dirnames, filenames in os.walk(os.path.dirname(module.__file__)):
+                paths.update(os.path.join(root, filename) for filename in filenames
+                             if filename.endswith(".py"))
+    for rule in ds_rules:
+        todo.extend(_module_of(fn) for fn in rule if fn is not None)
+
+    seen = set()
+    while todo:
+        module = todo.pop()
+        if module is None or module.__name__ in seen or not _is_project(module):
+            continue
+        seen.add(module.__name__)
+        paths.add(os.path.splitext(os.path.abspath(module.__file__))[0] + ".py")
+
+        is_package = hasattr(module, '__path__')
+        for (name, value) in vars(module).items():
+            # Submodules are set on package when they're imported
+            # from anywhere, only its own imports are followed
+            if is_package and isinstance(value, types.ModuleType) and \
+                    value.__name__ == module.__name__ + "." + name:
+                continue
+            todo.append(_module_of(value))
+    return sorted(path for path in paths if os.path.exists(path))
+
+
+def code_fingerprint(ty, ds_rules, modules=()):
+    h = hashlib.sha1(str(ty))
+    for path in source_files(ds_rules, modules):
+        with open(path, "rb") as f:
+            h.update(f.read())
+    return h.hexdigest()
+
+
+class ParseCache(object):
+    """Cache in dir for code with fingerprint. It is passed to
+    workers, so contains only paths and settings"""
+    def __init__(self, path, fingerprint, max_size=DEFAULT_MAX_SIZE):
+        self.path = path
+        self.fingerprint = fingerprint
+        self.max_size = max_size
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _paths(self, digest, rel_path):
+        if isinstance(rel_path, unicode):
+            rel_path = rel_path.encode("utf-8")
+        key = hashlib.sha1("%s\0%s\0%s" % (self.fingerprint, digest, rel_path)).hexdigest()
+        base = os.path.join(self.path, key[:2], key)
+        return (base + ".json", base + ".out",)
+
+    def get(self, digest, rel_path):
+        """Returns (entry, path of output or None) or None"""
+        (meta_path, out_path) = self._paths(digest, rel_path)
+        try:
+            with timing.phase("cache.get"):
+                with open(meta_path, "rt") as f:
+                    meta = json.load(f)
+                if meta['modified'] and not os.path.exists(out_path):
+                    return None
+                # Marks as recently used
+                os.utime(meta_path, None)
+        except (IOError, OSError, ValueError):
+            return None
+        return (meta['entry'], out_path if meta['modified'] else None,)
+
+    def put(self, digest, rel_path, entry, out_path=None):
+        """Stores entry, out_path is output file if it differs from
+        source. Output is linked into cache if it is possible, as
+        outputs are never modified in place"""
+        (meta_path, cached_out_path) = self._paths(digest, rel_path)
+        dirname = os.path.dirname(meta_path)
+        suffix = ".%d.tmp" % os.getpid()
+        with timing.phase("cache.put"):
+            try:
+                if not os.path.exists(dirname):
+                    os.makedirs(dirname)
+                if out_path:
+                    link_or_copy(out_path, cached_out_path + suffix)
+                    os.rename(cached_out_path + suffix, cached_out_path)
+                with open(meta_path + suffix, "wt") as f:
+                    json.dump({'entry': entry, 'modified': bool(out_path)}, f)
+                os.rename(meta_path + suffix, meta_path)
+            except (IOError, OSError) as e:
+                # Cache is an optimization, build shouldn't fail
+                log.warn("Can't cache %s: %s", rel_path, e)
+
+    def prune(self):
+        """Evicts least recently used entries until cache fits into
+        max size, returns stats"""
+        entries = {}
+        total = 0
+        for root, dirnames, filenames in os.walk(self.path):
+            for name in filenames:
+                path = os.path.join(root, name)
+                st = os.stat(path)
+                if name.endswith(".tmp"):
+                    if st.st_mtime < time.time() - 3600:
+                        # Left by a killed build
+                        os.remove(path)
+                    continue
+                (key, ext) = os.path.splitext(path)
+                entry = entries.setdefault(key, [0, 0])
+                entry[1] += st.st_size
+                if ext == ".json":
+                    entry[0] = st.st_mtime
+                total += st.st_size
+
+        evicted = 0
+        for (key, (mtime, size)) in sorted(entries.items(), key=lambda e: e[1][0]):
+            if total <= self.max_size:
+                break
+            for ext in (".json", ".out"):
+                if os.path.exists(key + ext):
+                    os.remove(key + ext)
+            total -= size
+            evicted += 1
+
+        return {'entries': len(entries) - evicted, 'size': total, 'evicted': evicted}
+
+
+def link_or_copy(src, dest):
+    if os.path.lexists(dest):
+        os.remove(dest)
+    fastcopy.copy_file("hardlink", src, dest)
@@ -0,0 +1,75 @@
+import errno
+import logging as log
+from manifest import file_hash
+import os
+import timing
+
+"""Content-addressed deduplication of docset output.
+
+Rustdoc repeats the same assets and identical pages (redirects,
+reexports) many times. Every unique blob is kept once and its
+duplicates are replaced with hard links to it, so docset takes
+less space and tarfile stores duplicates as links in archive.
+
+Outputs are never modified in place (process_file removes them
+first), so linked files could be safely rebuilt one by one"""
+
+# Errors which mean files can't be linked on this file system
+LINK_ERRNOS = set([errno.EXDEV, errno.EPERM, errno.EMLINK, errno.EOPNOTSUPP])
+
+
+def link_duplicate(original, path):
+    """Atomically replaces path with a hard link to original"""
+    temp_path = path + ".dedup"
+    if os.path.lexists(temp_path):
+        os.remove(temp_path)
+    os.link(original, temp_path)
+    os.rename(temp_path, path)
+
+
+def dedup(doc_dir, rel_paths):
+    """Links files with identical content, paths are relative to
+    doc_dir. The first path in sorted order keeps its file.
+    Returns stats: number of files, duplicates and bytes saved"""
+    stats = {'files': 0, 'duplicates': 0, 'linked': 0, 'bytes_saved': 0}
+
+    # Only files of the same size could be equal, so
+    # most of files are never read
+    by_size = {}
+    for rel_path in sorted(rel_paths):
+        path = os.path.join(doc_dir, rel_path)
+        st = os.lstat(path)
+        by_size.setdefault(st.st_size, []).append((path, st,))
+        stats['files'] += 1
+
+    with timing.phase("dedup"):
+        for (size, files) in by_size.items():
+            if size == 0 or len(files) < 2:
+                continue
+
+            blobs = {}
+            for (path, st) in files:
+                digest = file_hash(path)
+                original = blobs.get(digest)
+                if original is None:
+                    blobs[digest] = (path, st,)
+                    continue
+
+                stats['duplicates'] += 1
+                stats['bytes_saved'] += size
+                (original_path, original_st) = original
+                if (st.st_dev, st.st_ino) == (original_st.st_dev, original_st.st_ino):
+                    # Already linked by previous build
+                    continue
+
+                try:
+                    link_duplicate(original_path, path)
+                    stats['linked'] += 1
+                except OSError as e:
+                    if e.errno not in LINK_ERRNOS:
+                        raise
+                    log.warn("Can't link %s to %s: %s", path, original_path, e)
+                    stats['duplicates'] -= 1
+                    stats['bytes_saved'] -= size
+
+    return stats
@@ -0,0 +1,301 @@
+from index import apply_delta
+from io import BytesIO
+import json
+import logging as log
+from manifest import file_hash
+import os
+import re
+import shutil
+import sqlite3
+import tarfile
+import time
+
+"""Delta updates of published docsets.
+
+Every published archive is remembered in delta dir: SHA1 of its
+files and a copy of its index. Next publish writes a delta archive
+against it with files which were added or changed (stored once per
+content, as blobs/<sha1>), paths of removed files and rows which
+were added to or removed from searchIndex, so index isn't shipped
+as a whole. Deltas are listed in a chain manifest, so subscriber
+with any of recent versions applies deltas one by one instead of
+downloading full archive.
+
+Version of docset is SHA1 of its full archive, the same as in feed.
+Index is shipped as a file if it has tables besides searchIndex
+(i.e. searchText of full-text search), which can't be diffed by
+rows.
+
+Build without changes isn't published as a delta, so it doesn't
+push useful deltas out of chain. Chain lists SHA1 of every delta,
+which is checked before it is applied, and paths in delta should
+stay inside docset"""
+
+FORMAT_VERSION = 1
+
+INDEX_PATH = "Contents/Resources/docSet.dsidx"
+
+DEFAULT_KEEP = 5
+
+# Tables kept in sync by index.apply_delta
+ROW_DIFF_TABLES = frozenset(["searchIndex", "queryLeaf", "queryName", "queryTrigram"])
+
+
+SHA1_RE = re.compile(r"^[0-9a-f]{40}$")
+
+
+class DeltaError(Exception):
+    pass
+
+
+def safe_path(docset_dir, rel_path):
+    """Returns full path of rel_path from delta, raises DeltaError
+    if it isn't a relative path inside docset_dir"""
+    parts = rel_path.replace("\\", "/").split("/")
+    if not rel_path or os.path.isabs(rel_path) or os.pardir in parts:
+        raise DeltaError("Unsafe path in delta: %r" % rel_path)
+    path = os.path.join(docset_dir, rel_path)
+    # Links inside docset shouldn't lead out of it either
+    real_dir = os.path.realpath(docset_dir)
+    real_path = os.path.realpath(os.path.dirname(path))
+    if real_path != real_dir and not real_path.startswith(real_dir + os.sep):
+        raise DeltaError("Path in delta leads out of docset: %r" % rel_path)
+    return path
+
+
+def index_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        return set(conn.execute("SELECT name, type, path FROM searchIndex;"))
+    finally:
+        conn.close()
+
+
+def can_diff_rows(path):
+    conn = sqlite3.connect(path)
+    try:
+        tables = set(name for (name,) in conn.execute(
+            "SELECT name FROM sqlite_master WHERE type = 'table';"))
+    finally:
+        conn.close()
+    # sqlite_stat1 is created by ANALYZE
+    return all(name in ROW_DIFF_TABLES or name.startswith("sqlite_") for name in tables)
+
+
+def diff_files(old, new):
+    """Compares {path: sha1} of two versions, returns
+    (added, modified, removed)"""
+    added = dict((path, digest) for (path, digest) in new.items() if path not in old)
+    modified = dict((path, [old[path], digest]) for (path, digest) in new.items()
+                    if path in old and old[path] != digest)
+    removed = dict((path, digest) for (path, digest) in old.items() if path not in new)
+    return (added, modified, removed,)
+
+
+def add_bytes(tar, name, data):
+    info = tarfile.TarInfo(name)
+    info.size = len(data)
+    info.mtime = int(time.time())
+    tar.addfile(info, BytesIO(data))
+
+
+def write_delta(path, meta, root_dir, blobs):
+    """Writes delta archive with meta and files of root_dir with
+    given {sha1: rel_path}"""
+    with tarfile.open(path, "w:gz") as tar:
+        add_bytes(tar, "delta.json", json.dumps(meta, sort_keys=True))
+        for (digest, rel_path) in sorted(blobs.items()):
+            tar.add(os.path.join(root_dir, rel_path), "blobs/" + digest)
+
+
+class DeltaFeed(object):
+    """Delta dir of docset with given name: state of the last
+    published version, its index, delta archives and chain
+    manifest <name>.deltas.json. keep is a number of deltas in
+    chain, older ones are removed"""
+    def __init__(self, path, name, keep=DEFAULT_KEEP):
+        self.path = path
+        self.name = name
+        self.keep = keep
+        self.state_path = os.path.join(path, name + ".state.json")
+        self.index_path = os.path.join(path, name + ".dsidx")
+        self.chain_path = os.path.join(path, name + ".deltas.json")
+        if not os.path.exists(path):
+            os.makedirs(path)
+
+    def _load(self, path, default):
+        if not os.path.exists(path):
+            return default
+        try:
+            with open(path, "rt") as f:
+                return json.load(f)
+        except ValueError as e:
+            log.warn("Ignoring broken %s: %s", path, e)
+            return default
+
+    def _save(self, path, data):
+        with open(path + ".tmp", "wt") as f:
+            json.dump(data, f, indent=2, sort_keys=True)
+        os.rename(path + ".tmp", path)
+
+    def publish(self, root_dir, sha, hashes, archive_name, archive_size):
+        """Records published version of docset in root_dir, which
+        archive has given sha and file hashes. Returns stats of
+        written delta or None if there is no previous version"""
+        state = self._load(self.state_path, None)
+        chain = self._load(self.chain_path, {'version': FORMAT_VERSION, 'deltas': []})
+
+        stats = None
+        if state and state['sha'] != sha:
+            start = time.time()
+            stats = self._write(state, root_dir, sha, hashes)
+            if stats is None:
+                # The same docset in a different archive, previous
+                # version is kept, so deltas to it still work
+                log.info("%s has no changes since %s, delta isn't published",
+                         self.name, state['sha'])
+                return {'unchanged': state['sha']}
+            stats['seconds'] = time.time() - start
+            stats['full_size'] = archive_size
+            chain['deltas'].append({'from': state['sha'], 'to': sha,
+                                    'file': stats['file'], 'size': stats['size'],
+                                    'sha1': stats['sha1']})
+
+        # Deltas which are too old are removed
+        while len(chain['deltas']) > self.keep:
+            old = chain['deltas'].pop(0)
+            old_path = os.path.join(self.path, old['file'])
+            if os.path.exists(old_path):
+                os.remove(old_path)
+
+        chain.update({'latest': sha, 'full': archive_name, 'full_size': archive_size})
+        shutil.copy2(os.path.join(root_dir, INDEX_PATH), self.index_path)
+        self._save(self.state_path, {'sha': sha, 'hashes': hashes})
+        self._save(self.chain_path, chain)
+        return stats
+
+    def _write(self, state, root_dir, sha, hashes):
+        """Writes delta, returns its stats or None if there are
+        no changes"""
+        new_index = os.path.join(root_dir, INDEX_PATH)
+        old_hashes = state['hashes']
+        meta = {'version': FORMAT_VERSION, 'name': self.name,
+                'from': state['sha'], 'to': sha, 'index': None}
+
+        if os.path.exists(self.index_path) and \
+                can_diff_rows(self.index_path) and can_diff_rows(new_index):
+            old_rows = index_rows(self.index_path)
+            new_rows = index_rows(new_index)
+            meta['index'] = {'path': INDEX_PATH,
+                             'removed': sorted(old_rows - new_rows),
+                             'added': sorted(new_rows - old_rows)}
+            old_hashes = dict(old_hashes)
+            hashes = dict(hashes)
+            old_hashes.pop(INDEX_PATH, None)
+            hashes.pop(INDEX_PATH, None)
+
+        (added, modified, removed) = diff_files(old_hashes, hashes)
+        index = meta['index'] or {'added': [], 'removed': []}
+        if not (added or modified or removed or index['added'] or index['removed']):
+            return None
+        meta.update({'added': added, 'modified': modified, 'removed': removed})
+
+        blobs = {}
+        for (rel_path, digest) in added.items():
+            blobs.setdefault(digest, rel_path)
+        for (rel_path, (_, digest)) in modified.items():
+            blobs.setdefault(digest, rel_path)
+
+        file_name = "%s-%s-%s.delta.tgz" % (self.name, state['sha'][:8], sha[:8],)
+        path = os.path.join(self.path, file_name)
+        write_delta(path, meta, root_dir, blobs)
+
+        return {'file': file_name, 'path': path, 'size': os.path.getsize(path),
+                'sha1': file_hash(path),
+                'added': len(added), 'modified': len(modified), 'removed': len(removed),
+                'rows_added': len(index['added']), 'rows_removed': len(index['removed'])}
+
+
+def chain_path(chain, since):
+    """Returns deltas of chain which lead from version since to the
+    latest one or None if since isn't in chain"""
+    by_from = dict((delta['from'], delta) for delta in chain['deltas'])
+    deltas = []
+    version = since
+    while version != chain['latest']:
+        delta = by_from.get(version)
+        if delta is None:
+            return None
+        deltas.append(delta)
+        version = delta['to']
+    return deltas
+
+
+def remove_file(docset_dir, rel_path):
+    path = safe_path(docset_dir, rel_path)
+    os.remove(path)
+    dirname = os.path.dirname(path)
+    while dirname != docset_dir and not os.listdir(dirname):
+        os.rmdir(dirname)
+        dirname = os.path.dirname(dirname)
+
+
+def apply_archive(docset_dir, path, sha1):
+    """Applies delta archive with SHA1 from chain to docset dir in
+    place. Archive and its paths are checked first, as well as files
+    which are changed or removed by delta, so delta isn't applied to
+    a wrong version. Returns stats"""
+    start = time.time()
+    if not sha1 or file_hash(path) != sha1:
+        raise DeltaError("%s doesn't match its SHA1 in chain" % os.path.basename(path))
+
+    with tarfile.open(path, "r:*") as tar:
+        meta = json.load(tar.extractfile("delta.json"))
+        if meta.get('version') != FORMAT_VERSION:
+            raise DeltaError("Unsupported delta format %s" % meta.get('version'))
+
+        paths = list(meta['removed']) + list(meta['modified']) + list(meta['added'])
+        if meta['index']:
+            paths.append(meta['index']['path'])
+        for rel_path in paths:
+            safe_path(docset_dir, rel_path)
+        digests = list(meta['added'].values()) + \
+            [new for (_, new) in meta['modified'].values()]
+        if not all(SHA1_RE.match(digest) for digest in digests):
+            raise DeltaError("Broken blob names in delta")
+
+        expected = dict(meta['removed'])
+        expected.update((rel_path, old) for (rel_path, (old, _)) in meta['modified'].items())
+        for (rel_path, digest) in expected.items():
+            full_path = safe_path(docset_dir, rel_path)
+            if not os.path.exists(full_path) or file_hash(full_path) != digest:
+                raise DeltaError("%s doesn't match base version %s of delta" %
+                                 (rel_path, meta['from'],))
+
+        targets = dict(meta['added'])
+        targets.update((rel_path, new) for (rel_path, (_, new)) in meta['modified'].items())
+        for (rel_path, digest) in sorted(targets.items()):
+            dest_path = os.path.join(docset_dir, rel_path)
+            dirname = os.path.dirname(dest_path)
+            if not os.path.exists(dirname):
+                os.makedirs(dirname)
+            # Dirs created above might be links
+            safe_path(docset_dir, rel_path)
+            # Old file might be a hard link shared with other files
+            with open(dest_path + ".tmp", "wb") as f:
+                shutil.copyfileobj(tar.extractfile("blobs/" + digest), f)
+            os.rename(dest_path + ".tmp", dest_path)
+
+    for rel_path in sorted(meta['removed']):
+        remove_file(docset_dir, rel_path)
+
+    index = meta['index']
+    if index:
+        apply_delta(safe_path(docset_dir, index['path']),
+                    [tuple(row) for row in index['removed']],
+                    [tuple(row) for row in index['added']])
+
+    return {'from': meta['from'], 'to': meta['to'], 'files': len(targets),
+            'removed': len(meta['removed']),
+            'rows': len(index['added']) + len(index['removed']) if index else 0,
+            'seconds': time.time() - start}
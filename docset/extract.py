@@ -0,0 +1,181 @@
+from copy import deepcopy
+from io import BytesIO
+from lxml import etree
+import re
+import timing
+
+# //tag[@attr="value"] could be matched without XPath
+SIMPLE_XPATH_RE = re.compile(r'^//(\*|[a-zA-Z][a-zA-Z0-9]*)\[@([a-zA-Z_:-]+)="([^"]*)"\]$')
+
+ATTR_VALUE_RE = re.compile(r'@[a-zA-Z_:-]+="([^"]*)"')
+
+_compiled = {}
+_markers = {}
+
+
+def compiled(xpath):
+    """Returns precompiled XPath, compiled once per process"""
+    fn = _compiled.get(xpath)
+    if fn is None:
+        fn = etree.XPath(xpath)
+        _compiled[xpath] = fn
+    return fn
+
+
+def simple_xpath(xpath):
+    """Returns (tag, attr, value) for simple xpaths or None"""
+    m = SIMPLE_XPATH_RE.match(xpath)
+    if m:
+        return m.groups()
+    return None
+
+
+def markers(xpath):
+    """Returns a list of byte strings, which all must be present in
+    HTML for xpath to match anything, or None if there is no way to
+    say it. Every attribute value compared with a literal gives a
+    marker, which is a tuple of its quoted and unquoted forms"""
+    result = _markers.get(xpath, False)
+    if result is False:
+        values = ATTR_VALUE_RE.findall(xpath)
+        if values:
+            result = [('"%s"' % v, "'%s'" % v, "=%s" % v,) for v in values]
+        else:
+            result = None
+        _markers[xpath] = result
+    return result
+
+
+def could_match(data, filters):
+    """Cheap check if any filter could match HTML in data"""
+    for flt in filters:
+        required = markers(flt["xpath"])
+        if required is None:
+            return True
+        for forms in required:
+            if not any(form in data for form in forms):
+                break
+        else:
+            return True
+    return False
+
+
+def streamable(filters):
+    """Checks if filters could be evaluated with stream_nodes:
+    xpaths are simple and fns are marked with "streamable", i.e.
+    they need only a node and its children, not the rest of tree"""
+    return all(flt.get("streamable") and simple_xpath(flt["xpath"])
+               for flt in filters)
+
+
+def simple_filters(filters):
+    """Returns {attr: {value: [(tag, xpath)]}} for simple xpaths"""
+    simple = {}
+    for flt in filters:
+        parts = simple_xpath(flt["xpath"])
+        if parts:
+            (tag, attr, value) = parts
+            by_tag = simple.setdefault(attr, {}).setdefault(value, [])
+            if (tag, flt["xpath"],) not in by_tag:
+                by_tag.append((tag, flt["xpath"],))
+    return simple
+
+
+def matching_xpaths(simple, node):
+    for (attr, by_value) in simple.items():
+        value = node.get(attr)
+        if value is None:
+            continue
+        for (tag, xpath) in by_value.get(value, ()):
+            if tag == "*" or tag == node.tag:
+                yield xpath
+
+
+def stream_nodes(data, filters):
+    """Finds nodes matching streamable filters while HTML is parsed,
+    without building the whole tree. Returns {xpath: [node]}, where
+    nodes are detached copies in document order. Only matched nodes
+    and open elements are kept in memory"""
+    simple = simple_filters(filters)
+    nodes = dict((flt["xpath"], []) for flt in filters)
+    # Matched elements, which are still parsed, with their slots
+    open_matches = []
+
+    with timing.phase("html.stream"):
+        for (event, node) in etree.iterparse(BytesIO(data), events=("start", "end"),
+                                             html=True):
+            if not isinstance(node.tag, basestring):
+                continue
+
+            if event == "start":
+                slots = []
+                for xpath in matching_xpaths(simple, node):
+                    nodes[xpath].append(None)
+                    slots.append((xpath, len(nodes[xpath]) - 1,))
+                if slots:
+                    open_matches.append((node, slots,))
+                continue
+
+            if open_matches and open_matches[-1][0] is node:
+                (_, slots) = open_matches.pop()
+                copy = deepcopy(node)
+                for (xpath, i) in slots:
+                    nodes[xpath][i] = copy
+
+            # Matched nodes need their whole subtree
+            if not open_matches:
+                node.clear()
+                while node.getprevious() is not None:
+                    del node.getparent()[0]
+
+    return nodes
+
+
+class Extractor(object):
+    """Tree wrapper which evaluates xpaths of all filters at once.
+
+    Simple xpaths (//tag[@attr="value"]) are matched in a single
+    walk over the tree, others are evaluated with precompiled XPath.
+    Every xpath is evaluated only once, so index and TOC filters
+    with the same xpath share results. Nodes are collected before
+    any filter is applied, i.e. before TOC injection modifies tree.
+
+    Extractor could be passed instead of tree to scrape and
+    inject_toc, as it provides xpath. Without tree it could be
+    created with nodes from stream_nodes"""
+    def __init__(self, tree, filters, nodes=None):
+        self.tree = tree
+        self._nodes = nodes or {}
+        if tree is not None:
+            with timing.phase("extract"):
+                self._prefetch(filters)
+
+    def _prefetch(self, filters):
+        for flt in filters:
+            xpath = flt["xpath"]
+            if xpath not in self._nodes:
+                self._nodes[xpath] = [] if simple_xpath(xpath) else compiled(xpath)(self.tree)
+
+        simple = simple_filters(filters)
+        if not simple:
+            return
+
+        for node in self.tree.iter():
+            # Skip comments and processing instructions
+            if not isinstance(node.tag, basestring):
+                continue
+            for xpath in matching_xpaths(simple, node):
+                self._nodes[xpath].append(node)
+
+    def xpath(self, xpath):
+        nodes = self._nodes.get(xpath)
+        if nodes is not None:
+            return nodes
+        if self.tree is None:
+            return []
+        return compiled(xpath)(self.tree)
+
+    def getroot(self):
+        if self.tree is None:
+            return None
+        return self.tree.getroot()
@@ -0,0 +1,130 @@
+import errno
+import fcntl
+import logging as log
+import os
+import shutil
+import sys
+import tempfile
+
+"""Copy strategies for files which are copied to docset as is.
+
+- hardlink: only a directory entry is created. Fastest, but docset
+  shares files with source, so changes of source are visible in
+  docset, that's why it is never selected automatically
+- reflink: copy-on-write clone (Linux, FICLONE), data isn't copied
+  until one of files is modified
+- sendfile: copy in kernel without passing data through Python
+  (available in Python 3 only)
+- copy: shutil.copy2
+
+Strategy is selected once per build with select, auto picks the
+first supported one of reflink, sendfile and copy"""
+
+STRATEGIES = ["auto", "hardlink", "reflink", "sendfile", "copy"]
+
+# Strategies which don't copy any data
+NO_DATA_STRATEGIES = ("hardlink", "reflink",)
+
+# From linux/fs.h
+FICLONE = 0x40049409
+
+# Errors which mean strategy isn't possible for this pair of files
+FALLBACK_ERRNOS = set([errno.EXDEV, errno.EPERM, errno.EINVAL, errno.ENOTTY,
+                       errno.EOPNOTSUPP, errno.EMLINK, errno.ENOSYS])
+
+
+def hardlink(src, dest):
+    os.link(src, dest)
+
+
+def reflink(src, dest):
+    with open(src, "rb") as src_f:
+        with open(dest, "wb") as dest_f:
+            fcntl.ioctl(dest_f.fileno(), FICLONE, src_f.fileno())
+    shutil.copystat(src, dest)
+
+
+def sendfile(src, dest):
+    with open(src, "rb") as src_f:
+        with open(dest, "wb") as dest_f:
+            size = os.fstat(src_f.fileno()).st_size
+            offset = 0
+            while offset < size:
+                sent = os.sendfile(dest_f.fileno(), src_f.fileno(), offset, size - offset)
+                if sent == 0:
+                    break
+                offset += sent
+    shutil.copystat(src, dest)
+
+
+COPY_FNS = {
+    "hardlink": hardlink,
+    "reflink": reflink,
+    "sendfile": sendfile,
+    "copy": shutil.copy2,
+}
+
+
+def probe(strategy, dest_dir):
+    """Checks if strategy works for files in dest_dir"""
+    if strategy == "copy":
+        return True
+    if strategy == "sendfile":
+        return hasattr(os, "sendfile")
+    if strategy == "reflink" and not sys.platform.startswith("linux"):
+        return False
+
+    (fd, src) = tempfile.mkstemp(dir=dest_dir)
+    os.write(fd, "probe")
+    os.close(fd)
+    dest = src + ".probe"
+    try:
+        COPY_FNS[strategy](src, dest)
+        return True
+    except (IOError, OSError) as e:
+        if e.errno in FALLBACK_ERRNOS:
+            return False
+        raise
+    finally:
+        for path in (src, dest):
+            if os.path.exists(path):
+                os.remove(path)
+
+
+def select(name, src_dir, dest_dir):
+    """Returns name of strategy to copy files from src_dir to dest_dir.
+    src_dir is None if there are no files to copy on disk"""
+    if name not in STRATEGIES:
+        log.warn("Unknown copy strategy %s, using auto", name)
+        name = "auto"
+
+    if name == "auto":
+        candidates = ["reflink", "sendfile", "copy"]
+    else:
+        candidates = [name, "copy"]
+
+    same_dev = src_dir is not None and \
+        os.stat(src_dir).st_dev == os.stat(dest_dir).st_dev
+    for strategy in candidates:
+        # Links and clones can't cross file systems
+        if strategy in ("hardlink", "reflink") and not same_dev:
+            continue
+        if probe(strategy, dest_dir):
+            return strategy
+
+    return "copy"
+
+
+def copy_file(strategy, src, dest):
+    """Copies with strategy, falls back to a plain copy if
+    it isn't possible for these particular files"""
+    if strategy != "copy":
+        try:
+            COPY_FNS[strategy](src, dest)
+            return
+        except (IOError, OSError) as e:
+            if e.errno not in FALLBACK_ERRNOS:
+                raise
+            if os.path.exists(dest):
+                os.remove(dest)
+    shutil.copy2(src, dest)
@@ -0,0 +1,241 @@
+import hashlib
+import logging as log
+import os
+import requests
+import threading
+import time
+
+"""Conditional, resumable downloads with a local cache.
+
+Request carries If-None-Match with ETag of the previous download,
+so nothing is downloaded if there are no updates. Archive is
+saved into cache dir under a name derived from its ETag, so
+a completed download is reused and a partial one is resumed
+with Range request. Download runs in a background thread and
+could be read while it is still in progress, so processing of
+archive overlaps with downloading it"""
+
+CHUNK_SIZE = 1024*1024
+
+# (connect, read) in seconds, read timeout is
+# for a single chunk, not for whole download
+TIMEOUT = (10, 60)
+
+# Attempts to resume broken download
+RETRIES = 3
+
+
+class DownloadError(IOError):
+    pass
+
+
+def expected_size(response):
+    """Returns full size of file from response headers or None"""
+    content_range = response.headers.get('content-range')
+    if content_range and "/" in content_range:
+        total = content_range.rsplit("/", 1)[1]
+        return int(total) if total.isdigit() else None
+    length = response.headers.get('content-length')
+    return int(length) if length and length.isdigit() else None
+
+
+class Download(object):
+    """Download of url with etag into path. Data is written into
+    path + ".part", which is renamed to path on completion"""
+    def __init__(self, session, url, etag, path, timeout, retries):
+        self.session = session
+        self.url = url
+        self.etag = etag
+        self.path = path
+        self.part_path = path + ".part"
+        self.timeout = timeout
+        self.retries = retries
+        self.cond = threading.Condition()
+        self.error = None
+        self.thread = None
+
+        if os.path.exists(path):
+            self.done = True
+            self.size = os.path.getsize(path)
+        else:
+            self.done = False
+            # Created before start, so reader could open it
+            with open(self.part_path, "ab"):
+                pass
+            self.size = os.path.getsize(self.part_path)
+
+    def start(self, response=None):
+        """Starts downloading in background, response is an already
+        sent request for the whole file, which could be reused"""
+        if self.done:
+            if response is not None:
+                response.close()
+            return self
+
+        if self.size and response is not None:
+            # Resumed with Range instead
+            response.close()
+            response = None
+
+        self.thread = threading.Thread(target=self._run, args=(response,))
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def _request(self):
+        headers = {}
+        if self.size:
+            headers['Range'] = "bytes=%d-" % self.size
+            if self.etag:
+                headers['If-Range'] = self.etag
+        response = self.session.get(self.url, headers=headers, stream=True,
+                                    timeout=self.timeout)
+        response.raise_for_status()
+        return response
+
+    def _save(self, response):
+        skip = 0
+        if response.status_code != 206:
+            if self.etag and response.headers.get('etag') != self.etag:
+                raise DownloadError("%s was changed during download" % self.url)
+            # Ranges aren't supported, already saved part is skipped
+            skip = self.size
+
+        with open(self.part_path, "ab") as f:
+            for chunk in response.iter_content(CHUNK_SIZE):
+                if skip:
+                    dropped = min(skip, len(chunk))
+                    chunk = chunk[dropped:]
+                    skip -= dropped
+                    if not chunk:
+                        continue
+                f.write(chunk)
+                f.flush()
+                with self.cond:
+                    self.size += len(chunk)
+                    self.cond.notify_all()
+
+        # Connection might be closed before all data is sent
+        expected = expected_size(response)
+        if expected is not None and self.size < expected:
+            raise IOError("Got %d bytes of %d" % (self.size, expected,))
+
+    def _run(self, response):
+        attempt = 0
+        while True:
+            try:
+                if response is None:
+                    response = self._request()
+                self._save(response)
+                break
+            except (requests.RequestException, IOError) as e:
+                attempt += 1
+                if isinstance(e, DownloadError) or attempt > self.retries:
+                    with self.cond:
+                        self.error = e
+                        self.cond.notify_all()
+                    return
+                delay = 2 ** (attempt - 1)
+                log.warn("Download of %s failed (%s), resuming in %ds", self.url, e, delay)
+                time.sleep(delay)
+                response = None
+
+        os.rename(self.part_path, self.path)
+        with self.cond:
+            self.done = True
+            self.cond.notify_all()
+
+    def wait_for(self, size):
+        """Blocks until size bytes are available or download is
+        done, returns number of available bytes"""
+        with self.cond:
+            while not self.done and self.error is None and \
+                    (size is None or self.size < size):
+                self.cond.wait(1)
+            if self.error is not None:
+                raise DownloadError("Download of %s failed: %s" % (self.url, self.error))
+            return self.size
+
+    def wait(self):
+        """Waits for download to complete"""
+        self.wait_for(None)
+        return self
+
+    def reader(self):
+        return DownloadReader(self)
+
+
+class DownloadReader(object):
+    """Read-only file, which follows download in progress:
+    read blocks until requested data is downloaded"""
+    def __init__(self, download):
+        self.download = download
+        self.f = open(download.path if download.done else download.part_path, "rb")
+        self.pos = 0
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            end = self.download.wait_for(None)
+        else:
+            end = min(self.download.wait_for(self.pos + size), self.pos + size)
+        data = self.f.read(end - self.pos)
+        self.pos += len(data)
+        return data
+
+    def close(self):
+        self.f.close()
+
+
+def cache_name(url, etag):
+    key = etag if etag else url
+    return "%s-%s" % (os.path.basename(url), hashlib.sha1(key).hexdigest()[:16],)
+
+
+class Fetcher(object):
+    """Downloads files into cache_dir, which keeps keep
+    latest complete downloads"""
+    def __init__(self, cache_dir, timeout=TIMEOUT, retries=RETRIES, keep=2):
+        self.cache_dir = cache_dir
+        self.timeout = timeout
+        self.retries = retries
+        self.keep = keep
+        self.session = requests.Session()
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+
+    def open(self, url, etag=None):
+        """Starts download of url, returns None if it wasn't
+        modified since etag, otherwise a started Download"""
+        headers = {'If-None-Match': etag} if etag else {}
+        response = self.session.get(url, headers=headers, stream=True,
+                                    timeout=self.timeout)
+        if response.status_code == 304:
+            response.close()
+            return None
+        response.raise_for_status()
+
+        new_etag = response.headers.get('etag')
+        path = os.path.join(self.cache_dir, cache_name(url, new_etag))
+        if not new_etag:
+            # Without ETag there is no way to know if previous
+            # download is the same file
+            for stale in (path, path + ".part"):
+                if os.path.exists(stale):
+                    os.remove(stale)
+        return Download(self.session, url, new_etag, path,
+                        self.timeout, self.retries).start(response)
+
+    def prune(self, current=None):
+        """Removes all but keep latest downloads and partial
+        downloads other than current"""
+        complete = []
+        for name in os.listdir(self.cache_dir):
+            path = os.path.join(self.cache_dir, name)
+            if name.endswith(".part"):
+                if current is None or path != current.part_path:
+                    os.remove(path)
+            else:
+                complete.append((os.path.getmtime(path), path,))
+
+        for (_, path) in sorted(complete, reverse=True)[self.keep:]:
+            os.remove(path)
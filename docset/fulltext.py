@@ -0,0 +1,100 @@
+import re
+
+"""Full-text search over text of pages.
+
+Text is stored in FTS5 table searchText next to searchIndex in
+docSet.dsidx, Dash ignores it. unicode61 tokenizer splits Rust
+paths at "::" and keeps snake_case names as a single token, as
+"_" is a token character. Parts of such names are indexed in a
+separate terms column, so both into_iter and iter find
+Vec::into_iter, while phrases in body stay intact"""
+
+SCHEMA = ("CREATE VIRTUAL TABLE searchText USING fts5("
+          "path UNINDEXED, title, body, terms, "
+          "tokenize = \"unicode61 tokenchars '_'\");")
+
+INSERT = "INSERT INTO searchText(path, title, body, terms) VALUES (?, ?, ?, ?);"
+
+# Text of these elements isn't a part of page content
+SKIP_TAGS = frozenset(["script", "style", "nav", "head", "noscript"])
+
+# rustdoc puts content into section#main, sidebar and search
+# form are outside of it
+CONTENT_XPATH = '//*[@id="main"]'
+
+WORD_RE = re.compile(r"\w+", re.UNICODE)
+SPACE_RE = re.compile(r"\s+", re.UNICODE)
+
+
+def _texts(node, out):
+    if not isinstance(node.tag, basestring) or node.tag in SKIP_TAGS:
+        return
+    if node.text:
+        out.append(node.text)
+    for child in node:
+        _texts(child, out)
+        if child.tail:
+            out.append(child.tail)
+
+
+def page_text(tree):
+    """Returns (title, text) of parsed HTML page"""
+    root = tree.getroot()
+    title = root.findtext(".//title") or ""
+    content = root.xpath(CONTENT_XPATH)
+    if content:
+        node = content[0]
+    else:
+        node = root.find("body")
+        if node is None:
+            node = root
+
+    out = []
+    _texts(node, out)
+    return (SPACE_RE.sub(" ", title).strip(),
+            SPACE_RE.sub(" ", " ".join(out)).strip(),)
+
+
+def name_terms(text):
+    """Returns parts of snake_case names found in text"""
+    terms = []
+    seen = set()
+    for word in WORD_RE.findall(text):
+        if "_" not in word.strip("_") or word in seen:
+            continue
+        seen.add(word)
+        terms.extend(part for part in word.split("_") if part)
+    return " ".join(terms)
+
+
+def text_row(path, title, body):
+    """Returns values for INSERT"""
+    return (path, title, body, name_terms(title + " " + body),)
+
+
+def match_expression(query):
+    """Converts a free form query into FTS5 MATCH expression, words
+    are required, Rust paths (std::vec::Vec) become phrases and a
+    trailing * makes the last word of a phrase a prefix"""
+    terms = []
+    for part in query.split():
+        words = WORD_RE.findall(part)
+        if not words:
+            continue
+        term = '"%s"' % " ".join(words)
+        if part.endswith("*"):
+            term += " *"
+        terms.append(term)
+    return " AND ".join(terms)
+
+
+def search(conn, query, limit=20):
+    """Returns [(path, title, snippet)] of pages matching query,
+    best first"""
+    expr = match_expression(query)
+    if not expr:
+        return []
+    return conn.execute(
+        "SELECT path, title, snippet(searchText, 2, '[', ']', '...', 12) "
+        "FROM searchText WHERE searchText MATCH ? ORDER BY rank LIMIT ?;",
+        (expr, limit,)).fetchall()
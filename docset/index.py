@@ -1,30 +1,226 @@
+import fulltext as fts
 import logging as log
 import os
 import sqlite3
+from symbols import SymbolTable
+import time
+import timing
+
+# 0 means rows are buffered until memory limit is reached
+DEFAULT_BATCH_SIZE = 0
+
+DEFAULT_MEMORY_LIMIT = 64*1024*1024
+
+# Memory usage of buffer is checked every N rows
+MEMORY_CHECK_ROWS = 1024
+
+# Texts of pages are written every N pages
+TEXT_BATCH_SIZE = 256
+
+# Index is always built from scratch, so there is nothing
+# to protect with journal or syncs during the build
+PRAGMAS = [
+    ("page_size", 4096),
+    ("journal_mode", "MEMORY"),
+    ("synchronous", "OFF"),
+    ("temp_store", "MEMORY"),
+]
+
+
+def dash_type(ty, path, ty_map_fn):
+    """Maps type to Dash type, returns None if it can't be indexed"""
+    if not ty:
+        return None
+
+    if ty_map_fn:
+        dash_ty = ty_map_fn(ty)
+    else:
+        dash_ty = ty
+
+    if not dash_ty:
+        log.error("Unknown type: %s, path %s", ty, path)
+    return dash_ty
 
 
 class Index(object):
-    def __init__(self, path):
+    """Buffers rows in a compact SymbolTable and writes them when
+    buffer reaches memory_limit bytes or batch_size rows (if it
+    isn't 0) or on flush, so usually all rows are bulk loaded at
+    once. Unique index is created only on flush, as it is much
+    cheaper than maintaining it during inserts.
+
+    If fulltext is set, texts of pages are written to searchText
+    (see docset.fulltext). If query_tables is set, side tables for
+    docset.query are built on flush"""
+    def __init__(self, path, batch_size=DEFAULT_BATCH_SIZE,
+                 memory_limit=DEFAULT_MEMORY_LIMIT, fulltext=False,
+                 query_tables=False):
         self._path = path
+        self._batch_size = max(0, batch_size)
+        self._memory_limit = memory_limit
+        self._symbols = SymbolTable()
+        self._total = 0
+        self._elapsed = 0.0
+        self._fulltext = fulltext
+        self._query_tables = query_tables
+        self._texts = []
+        self._text_total = 0
+        self._text_elapsed = 0.0
+
         if os.path.exists(path):
             os.remove(path)
         self._conn = sqlite3.connect(path)
+        for (name, value) in PRAGMAS:
+            self._conn.execute("PRAGMA %s = %s;" % (name, value))
         self._conn.execute("CREATE TABLE searchIndex(id INTEGER PRIMARY KEY, name TEXT, type TEXT, path TEXT);")
-        self._cursor = self._conn.cursor()
+        if fulltext:
+            self._conn.execute(fts.SCHEMA)
 
     def flush(self):
-        self._cursor.close()
-        self._conn.commit()
-        self._conn.close()
+        """Writes pending rows and finalizes index.
+        Returns stats as a dict"""
+        self._write_batch()
+        self._write_texts()
+
+        start = time.time()
+        if self._fulltext:
+            with timing.phase("sqlite.fulltext"):
+                # Merges segments written by batches
+                self._conn.execute("INSERT INTO searchText(searchText) VALUES ('optimize');")
+            self._text_elapsed += time.time() - start
+            start = time.time()
+
+        with timing.phase("sqlite.finalize"):
+            # Duplicates are possible, first one wins
+            duplicates = self._conn.execute(
+                "DELETE FROM searchIndex WHERE id NOT IN "
+                "(SELECT MIN(id) FROM searchIndex GROUP BY name, type, path);").rowcount
+            self._conn.execute("CREATE UNIQUE INDEX anchor ON searchIndex (name, type, path);")
+            if self._query_tables:
+                # Imported here, so query isn't a part of code
+                # fingerprint of processing (see docset.cache)
+                from query import build_query_tables
+                build_query_tables(self._conn)
+            self._conn.commit()
+            self._conn.execute("ANALYZE;")
+            self._conn.execute("VACUUM;")
+            self._conn.close()
+        self._elapsed += time.time() - start
+
+        stats = {
+            'rows': self._total - duplicates,
+            'duplicates': duplicates,
+            'seconds': self._elapsed,
+            'rows_per_sec': self._total / self._elapsed if self._elapsed else 0.0,
+            'memory': self._symbols.peak_memory
+        }
+        if self._fulltext:
+            stats['fulltext'] = {'pages': self._text_total,
+                                 'seconds': self._text_elapsed}
+        return stats
+
+    def add(self, name, ty, path, ty_map_fn):
+        dash_ty = dash_type(ty, path, ty_map_fn)
+        if dash_ty:
+            self.insert(name, dash_ty, path)
+
+    def insert(self, name, dash_ty, path):
+        """Inserts a row with already resolved Dash type"""
+        self._symbols.add(name, dash_ty, path)
+        count = len(self._symbols)
+        if self._batch_size and count >= self._batch_size:
+            self._write_batch()
+        elif count % MEMORY_CHECK_ROWS == 0 and \
+                self._symbols.memory() >= self._memory_limit:
+            self._write_batch()
+
+    def extend(self, rows):
+        """Inserts rows collected by RowCollector"""
+        for (name, dash_ty, path) in rows:
+            self.insert(name, dash_ty, path)
+
+    def add_text(self, path, title, body):
+        """Adds text of page, ignored unless index is fulltext"""
+        if not self._fulltext:
+            return
+        self._texts.append(fts.text_row(path, title, body))
+        if len(self._texts) >= TEXT_BATCH_SIZE:
+            self._write_texts()
+
+    def extend_texts(self, texts):
+        """Adds texts collected by RowCollector"""
+        for (path, title, body) in texts:
+            self.add_text(path, title, body)
+
+    def _write_texts(self):
+        if not self._texts:
+            return
+
+        start = time.time()
+        with timing.phase("sqlite.fulltext"):
+            self._conn.executemany(fts.INSERT, self._texts)
+        self._text_elapsed += time.time() - start
+        self._text_total += len(self._texts)
+        self._texts = []
+
+    def _write_batch(self):
+        if not len(self._symbols):
+            return
+
+        # Updates peak memory
+        self._symbols.memory()
+        start = time.time()
+        with timing.phase("sqlite.insert"):
+            self._conn.executemany("INSERT INTO searchIndex(name, type, path) VALUES (?, ?, ?);",
+                                   self._symbols.rows())
+        self._elapsed += time.time() - start
+        self._total += len(self._symbols)
+        self._symbols.clear()
+
+
+class RowCollector(object):
+    """Index stand-in which only collects resolved rows,
+    used by worker processes which can't share sqlite connection"""
+    def __init__(self):
+        self.rows = []
+        self.texts = []
+        self.anchors = None
 
     def add(self, name, ty, path, ty_map_fn):
-        if ty:
-            if ty_map_fn:
-                dash_ty = ty_map_fn(ty)
-            else:
-                dash_ty = ty
-
-            if not dash_ty:
-                log.error("Unknown type: %s, path %s", ty, path)
-            else:
-                self._cursor.execute("INSERT OR IGNORE INTO searchIndex(name, type, path) VALUES (?, ?, ?);", (name, dash_ty, path,))
+        dash_ty = dash_type(ty, path, ty_map_fn)
+        if dash_ty:
+            self.rows.append((name, dash_ty, path,))
+
+    def add_text(self, path, title, body):
+        self.texts.append((path, title, body,))
+
+    def set_anchors(self, anchors):
+        self.anchors = anchors
+
+
+def apply_delta(path, removed, added, removed_texts=(), added_texts=()):
+    """Updates an already built index in place: deletes removed
+    rows and inserts added ones, which aren't there yet. Texts are
+    replaced by page, removed_texts are paths of pages and
+    added_texts are (path, title, body)"""
+    from query import add_query_rows, has_query_tables, remove_query_rows
+    conn = sqlite3.connect(path)
+    try:
+        with conn:
+            query_tables = has_query_tables(conn)
+            if query_tables:
+                remove_query_rows(conn, removed)
+            conn.executemany("DELETE FROM searchIndex WHERE name = ? AND type = ? AND path = ?;",
+                             removed)
+            conn.executemany("INSERT OR IGNORE INTO searchIndex(name, type, path) VALUES (?, ?, ?);",
+                             added)
+            if query_tables:
+                add_query_rows(conn, added)
+            # Index might have no searchText at all
+            if removed_texts or added_texts:
+                conn.executemany("DELETE FROM searchText WHERE path = ?;",
+                                 ((text_path,) for text_path in removed_texts))
+                conn.executemany(fts.INSERT,
+                                 (fts.text_row(*text) for text in added_texts))
+    finally:
+        conn.close()
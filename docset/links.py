@@ -0,0 +1,131 @@
+import os
+import re
+from urllib import unquote
+from urlparse import urlsplit
+
+"""Validation of index paths and links between pages.
+
+Element ids (and names of anchors, which include dashAnchors of
+TOC) and hrefs of links are collected from trees pages are already
+parsed into, pages which aren't parsed are scanned with a regex.
+They're kept per page in manifest entry, so incremental builds
+check unchanged pages as well. After build they're loaded into
+AnchorIndex, which checks that every index path and every local
+link points to an existing page and, if it has a fragment, to an
+existing anchor of that page. Fragments of pages which were copied
+as is aren't checked, as their anchors are unknown"""
+
+# Number of broken links and paths listed in report
+DEFAULT_REPORT_LIMIT = 20
+
+ID_RE = re.compile(r"""<[^>]*?\s(?:id|name)\s*=\s*["']([^"']*)["']""")
+
+HREF_RE = re.compile(r"""<a\s[^>]*?href\s*=\s*["']([^"']*)["']""", re.IGNORECASE)
+
+
+def is_local(href):
+    """Links without scheme and host, which point into docset"""
+    parts = urlsplit(href)
+    return not parts.scheme and not parts.netloc and not href.startswith("/")
+
+
+def page_anchors(ids, hrefs):
+    """Compact anchors of a page as stored in manifest: unique ids
+    and unique local links"""
+    return {'ids': sorted(set(ids)),
+            'links': sorted(set(href for href in hrefs if is_local(href)))}
+
+
+def tree_anchors(tree):
+    # Smart strings would keep the whole tree alive
+    return page_anchors(tree.xpath("//@id | //a/@name", smart_strings=False),
+                        tree.xpath("//a/@href", smart_strings=False))
+
+
+def scan_anchors(data):
+    """Anchors of a page which isn't parsed"""
+    return page_anchors((m.group(1).decode("utf-8", "replace") for m in ID_RE.finditer(data)),
+                        (m.group(1).decode("utf-8", "replace") for m in HREF_RE.finditer(data)))
+
+
+def resolve(page, href):
+    """Returns (target page, fragment) of local link from page,
+    target is None if link leads out of docset. Most of links are
+    plain paths, so they are resolved without urlsplit"""
+    (path, _, fragment) = href.partition("#")
+    path = path.partition("?")[0]
+    if "%" in path:
+        # Escapes are utf-8 bytes
+        path = unquote(path.encode("utf-8")).decode("utf-8") if isinstance(path, unicode) \
+            else unquote(path)
+    if not path:
+        return (page, fragment,)
+    target = os.path.join(os.path.dirname(page), path)
+    if target.startswith(".") or "/." in target or "//" in target:
+        target = os.path.normpath(target)
+        if target.startswith(os.pardir):
+            return (None, fragment,)
+    return (target, fragment,)
+
+
+class AnchorIndex(object):
+    """Pages of docset and their anchors, ids of every page
+    are kept as a frozenset"""
+    def __init__(self):
+        self.pages = set()
+        self._ids = {}
+        self._links = {}
+        self._paths = set()
+
+    def add(self, rel_path, entry):
+        """Adds manifest entry of a source file"""
+        if entry['dest']:
+            self.pages.add(entry['dest'])
+        anchors = entry.get('anchors')
+        if anchors is not None:
+            self._ids[rel_path] = frozenset(anchors['ids'])
+            if anchors['links']:
+                self._links[rel_path] = anchors['links']
+        self._paths.update(row[2] for row in entry['rows'])
+
+    def _problem(self, page, href):
+        (target, fragment) = resolve(page, href)
+        if target is None:
+            return "outside of docset"
+        if target not in self.pages:
+            return "missing page"
+        ids = self._ids.get(target)
+        if fragment and ids is not None and fragment not in ids:
+            return "missing anchor"
+        return None
+
+    def check(self, limit=DEFAULT_REPORT_LIMIT):
+        """Returns report with numbers of checked and broken index
+        paths and links and the first limit of both"""
+        report = {'paths': len(self._paths), 'links': 0,
+                  'broken_paths': 0, 'broken_links': 0, 'examples': []}
+
+        for path in sorted(self._paths):
+            problem = self._problem("", path)
+            if problem:
+                report['broken_paths'] += 1
+                if len(report['examples']) < limit:
+                    report['examples'].append("index %s: %s" % (path, problem,))
+
+        for page in sorted(self._links):
+            for href in self._links[page]:
+                report['links'] += 1
+                problem = self._problem(page, href)
+                if problem:
+                    report['broken_links'] += 1
+                    if len(report['examples']) < limit:
+                        report['examples'].append("%s -> %s: %s" % (page, href, problem,))
+        return report
+
+
+def check_entries(entries, limit=DEFAULT_REPORT_LIMIT):
+    """Checks {rel_path: manifest entry} of a build"""
+    anchors = AnchorIndex()
+    for (rel_path, entry) in entries.items():
+        anchors.add(rel_path, entry)
+    return anchors.check(limit)
@@ -0,0 +1,128 @@
+import hashlib
+import json
+import logging as log
+import os
+
+# Bump on any incompatible change of entries format
+VERSION = 2
+
+
+def file_hash(path):
+    """Returns SHA1 hex digest of file contents"""
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        while True:
+            chunk = f.read(1024*1024)
+            if not chunk:
+                break
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def encode_entry(entry):
+    return json.dumps(entry, separators=(',', ':'))
+
+
+def decode_entry(data):
+    return json.loads(data)
+
+
+class Entries(object):
+    """Mapping of relative source path to entry. Entries are kept
+    encoded as compact JSON, a string per file instead of tuples and
+    strings of every row, and are decoded on access, so rows of the
+    whole build aren't kept as objects"""
+    def __init__(self):
+        self._data = {}
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, rel_path):
+        return rel_path in self._data
+
+    def __iter__(self):
+        return iter(self._data)
+
+    def __getitem__(self, rel_path):
+        return decode_entry(self._data[rel_path])
+
+    def __setitem__(self, rel_path, entry):
+        self._data[rel_path] = encode_entry(entry)
+
+    def __delitem__(self, rel_path):
+        del self._data[rel_path]
+
+    def get(self, rel_path, default=None):
+        data = self._data.get(rel_path)
+        return decode_entry(data) if data is not None else default
+
+    def raw(self, rel_path):
+        """Encoded entry"""
+        return self._data[rel_path]
+
+    def set_raw(self, rel_path, data):
+        self._data[rel_path] = data
+
+    def keys(self):
+        return self._data.keys()
+
+    def items(self):
+        for (rel_path, data) in self._data.iteritems():
+            yield (rel_path, decode_entry(data),)
+
+    def values(self):
+        for data in self._data.itervalues():
+            yield decode_entry(data)
+
+
+class Manifest(object):
+    """Persistent record of a build, maps relative source path to
+    {'hash', 'rule', 'rows', 'dest'}, where rule is an index of
+    matched file rule, rows are emitted index rows and dest is a
+    path relative to Documents or None if nothing was written.
+
+    File is a header line followed by a line per entry, path and
+    entry as JSON separated by tab, so entries are loaded and saved
+    without decoding them.
+
+    Manifest is valid only for the same rules, which are identified
+    by fingerprint"""
+    def __init__(self, path, fingerprint):
+        self._path = path
+        self.fingerprint = fingerprint
+        self.entries = Entries()
+
+    def load(self):
+        """Loads previous entries if manifest exists and matches
+        fingerprint, otherwise keeps it empty"""
+        if not os.path.exists(self._path):
+            return self
+
+        entries = Entries()
+        try:
+            with open(self._path, "rt") as f:
+                header = json.loads(f.readline())
+                if header.get('version') != VERSION or \
+                   header.get('fingerprint') != self.fingerprint:
+                    log.info("Manifest %s is outdated, ignoring", self._path)
+                    return self
+                for line in f:
+                    (rel_path, data) = line.rstrip("\n").split("\t", 1)
+                    entries.set_raw(json.loads(rel_path), data)
+        except (ValueError, AttributeError) as e:
+            log.warn("Ignoring broken manifest %s: %s", self._path, e)
+            return self
+
+        self.entries = entries
+        return self
+
+    def save(self):
+        temp_path = self._path + ".tmp"
+        with open(temp_path, "wt") as f:
+            f.write(json.dumps({'version': VERSION,
+                                'fingerprint': self.fingerprint}))
+            f.write("\n")
+            for rel_path in sorted(self.entries):
+                f.write("%s\t%s\n" % (json.dumps(rel_path), self.entries.raw(rel_path),))
+        os.rename(temp_path, self._path)
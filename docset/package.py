@@ -0,0 +1,196 @@
+from collections import deque
+import hashlib
+from io import BytesIO
+from multiprocessing.pool import ThreadPool
+import multiprocessing
+import os
+import tarfile
+import timing
+import zlib
+
+"""Feed packaging: docset .tgz is written in a single pass.
+
+- archive is hashed while it is written, so it is never read back
+- gzip is compressed in blocks by a pool of threads (zlib releases
+  GIL). Every block is a separate gzip member and concatenated
+  members are a standard gzip file, which gunzip and tar handle
+- files are added as soon as build emits them, so packaging
+  overlaps with processing of the rest of files
+- files with the same content are stored once, duplicates are
+  stored as hard link members
+- archive is reproducible: members get fixed mtime and owner (and
+  gzip header has no time), so a rebuild of the same docset has the
+  same SHA1 and isn't published as a new version"""
+
+BLOCK_SIZE = 1024*1024
+
+# gzip header and trailer instead of a raw zlib stream
+GZIP_WBITS = 16 + zlib.MAX_WBITS
+
+# mtime of all archive members, as in reproducible builds
+ARCHIVE_MTIME = int(os.environ.get("SOURCE_DATE_EPOCH", 0))
+
+
+def normalize(info):
+    """Removes what differs between builds of the same files"""
+    info.mtime = ARCHIVE_MTIME
+    info.uid = info.gid = 0
+    info.uname = info.gname = ""
+    return info
+
+
+class HashingFile(object):
+    """Write-only file wrapper, which computes SHA1 and size
+    of everything written"""
+    def __init__(self, fileobj):
+        self.fileobj = fileobj
+        self.hash = hashlib.sha1()
+        self.size = 0
+
+    def write(self, data):
+        self.hash.update(data)
+        self.size += len(data)
+        self.fileobj.write(data)
+
+    def hexdigest(self):
+        return self.hash.hexdigest()
+
+
+def compress_block(data, level):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, GZIP_WBITS)
+    return compressor.compress(data) + compressor.flush()
+
+
+class BlockGzipWriter(object):
+    """Write-only gzip file, data is split into blocks of block_size,
+    which are compressed by threads in parallel and written in order.
+    threads=0 means one per CPU, with a single thread blocks are
+    compressed in place"""
+    def __init__(self, fileobj, level=9, block_size=BLOCK_SIZE, threads=1):
+        self.fileobj = fileobj
+        self.level = level
+        self.block_size = block_size
+        if threads <= 0:
+            threads = multiprocessing.cpu_count()
+        self.threads = threads
+        self.pool = ThreadPool(threads) if threads > 1 else None
+        # Bounded, so memory doesn't depend on archive size
+        self.pending = deque()
+        self.buf = []
+        self.buf_size = 0
+
+    def write(self, data):
+        self.buf.append(data)
+        self.buf_size += len(data)
+        while self.buf_size >= self.block_size:
+            data = "".join(self.buf)
+            self._compress(data[:self.block_size])
+            self.buf = [data[self.block_size:]]
+            self.buf_size -= self.block_size
+
+    def _compress(self, block):
+        if self.pool is None:
+            with timing.phase("package.gzip"):
+                self.fileobj.write(compress_block(block, self.level))
+            return
+
+        while len(self.pending) >= 2 * self.threads:
+            self._write_pending()
+        self.pending.append(self.pool.apply_async(compress_block, (block, self.level,)))
+
+    def _write_pending(self):
+        with timing.phase("package.gzip"):
+            self.fileobj.write(self.pending.popleft().get())
+
+    def close(self):
+        """Writes the rest of data, underlying file isn't closed"""
+        if self.buf_size:
+            self._compress("".join(self.buf))
+            self.buf = []
+            self.buf_size = 0
+        while self.pending:
+            self._write_pending()
+        if self.pool is not None:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+
+class Packager(object):
+    """Writes files of docset in root_dir into .tgz at path under
+    arcname, as they're added. Paths are relative to root_dir.
+    SHA1 of every added file is kept in hashes"""
+    def __init__(self, path, root_dir, arcname, threads=1, level=9):
+        self.path = path
+        self.root_dir = root_dir
+        self.arcname = arcname
+        self._file = open(path, "wb")
+        self._hashing = HashingFile(self._file)
+        self._gzip = BlockGzipWriter(self._hashing, level, threads=threads)
+        self._tar = tarfile.open(fileobj=self._gzip, mode="w|")
+        self._dirs = set()
+        self._blobs = {}
+        self.hashes = {}
+        self.stats = {'files': 0, 'links': 0, 'bytes': 0}
+
+    def _add_dir(self, rel_dir):
+        if rel_dir in self._dirs:
+            return
+        if rel_dir:
+            self._add_dir(os.path.dirname(rel_dir))
+        self._dirs.add(rel_dir)
+        path = os.path.join(self.root_dir, rel_dir)
+        self._tar.addfile(normalize(self._tar.gettarinfo(path, self._arcname(rel_dir))))
+
+    def _arcname(self, rel_path):
+        return self.arcname + "/" + rel_path if rel_path else self.arcname
+
+    def add(self, rel_path):
+        """Adds a file, it shouldn't be modified afterwards"""
+        with timing.phase("package.add"):
+            self._add_dir(os.path.dirname(rel_path))
+            arcname = self._arcname(rel_path)
+            info = normalize(self._tar.gettarinfo(os.path.join(self.root_dir, rel_path),
+                                                  arcname))
+            if info.islnk():
+                # Linked on disk with already added file
+                self._tar.addfile(info)
+                self.hashes[rel_path] = self.hashes[info.linkname[len(self.arcname) + 1:]]
+                self.stats['links'] += 1
+                return
+
+            with open(os.path.join(self.root_dir, rel_path), "rb") as f:
+                data = f.read()
+            digest = hashlib.sha1(data).hexdigest()
+            self.hashes[rel_path] = digest
+            original = self._blobs.get(digest)
+            if original is not None:
+                info.type = tarfile.LNKTYPE
+                info.linkname = original
+                info.size = 0
+                self._tar.addfile(info)
+                self.stats['links'] += 1
+            else:
+                self._blobs[digest] = arcname
+                self._tar.addfile(info, BytesIO(data))
+                self.stats['files'] += 1
+                self.stats['bytes'] += len(data)
+
+    def close(self):
+        """Finishes archive, returns stats with its SHA1 and size"""
+        self._tar.close()
+        self._gzip.close()
+        self._file.close()
+        self.stats['sha'] = self._hashing.hexdigest()
+        self.stats['size'] = self._hashing.size
+        return self.stats
+
+    def abort(self):
+        """Closes and removes unfinished archive"""
+        try:
+            if self._gzip.pool is not None:
+                self._gzip.pool.terminate()
+            self._file.close()
+        finally:
+            if os.path.exists(self.path):
+                os.remove(self.path)
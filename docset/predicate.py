@@ -34,10 +34,36 @@ def construct_predicate(**kwargs):
     return closure
 
 
-def rel_path(**kwargs):
-    f = construct_predicate(**kwargs)
-    def closure(ctx):
-        data = ctx['rel_path']
-        return f(data)
+class RelPath(object):
+    """Predicate over ctx['rel_path']. Unlike a plain closure
+    it keeps arguments, so rules could be analyzed and compiled
+    (see rules.compile_rules)"""
+    def __init__(self, **kwargs):
+        self.spec = kwargs
+        self._fn = construct_predicate(**kwargs)
 
-    return closure
+    def __call__(self, ctx):
+        return self._fn(ctx['rel_path'])
+
+    def __eq__(self, other):
+        return isinstance(other, RelPath) and self.spec == other.spec
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __hash__(self):
+        return hash(tuple(sorted(self.spec.items())))
+
+    def __repr__(self):
+        args = ", ".join("%s=%r" % pair for pair in sorted(self.spec.items()))
+        return "rel_path(%s)" % args
+
+    def __getstate__(self):
+        return self.spec
+
+    def __setstate__(self, spec):
+        self.__init__(**spec)
+
+
+def rel_path(**kwargs):
+    return RelPath(**kwargs)
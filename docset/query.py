@@ -0,0 +1,259 @@
+from collections import OrderedDict
+import logging as log
+import re
+import sqlite3
+from symbols import split_at
+import time
+import timing
+
+"""Symbol lookups over searchIndex of a built docset.
+
+Names are matched case-insensitively in 3 modes:
+
+- exact: full name (std::vec::Vec) or its last part (Vec)
+- prefix: full name or its last part starts with query
+- fuzzy: last part contains query as a subsequence (hmap finds
+  HashMap) or shares at least half of its trigrams (lenght finds
+  length)
+
+Side tables are built once, by build or on the first open:
+queryLeaf has every unique lowercased last part of name, queryName
+maps searchIndex rows to lowercased full names and leaves and
+queryTrigram maps trigrams to leaves. Dash ignores them"""
+
+MODES = ("exact", "prefix", "fuzzy")
+
+DEFAULT_LIMIT = 20
+
+DEFAULT_CACHE_SIZE = 1024
+
+# Fuzzy matches are fetched for this many leaves at once
+FUZZY_CHUNK = 64
+
+SCHEMA = [
+    "CREATE TABLE queryLeaf(id INTEGER PRIMARY KEY, leaf TEXT UNIQUE);",
+    "CREATE TABLE queryName(row INTEGER PRIMARY KEY, name TEXT, leaf INTEGER);",
+    "CREATE TABLE queryTrigram(trigram TEXT, leaf INTEGER, "
+    "PRIMARY KEY (trigram, leaf)) WITHOUT ROWID;",
+]
+
+INDEXES = [
+    "CREATE INDEX queryNameName ON queryName (name);",
+    "CREATE INDEX queryNameLeaf ON queryName (leaf);",
+]
+
+# Prefix matches are found as a range [prefix, prefix + MAX_CHAR)
+MAX_CHAR = u"\U0010ffff"
+
+
+def normalize(name):
+    if isinstance(name, str):
+        name = name.decode("utf-8")
+    return name.lower()
+
+
+def leaf_of(name):
+    return split_at(name, "::")[1]
+
+
+def trigrams(s):
+    return set(s[i:i + 3] for i in xrange(len(s) - 2))
+
+
+def has_query_tables(conn):
+    return conn.execute("SELECT COUNT(*) FROM sqlite_master "
+                        "WHERE type = 'table' AND name = 'queryName';").fetchone()[0] > 0
+
+
+class TableWriter(object):
+    """Adds rows to side tables, leaves are interned"""
+    def __init__(self, conn):
+        self._conn = conn
+        self._leaf_ids = dict((leaf, i) for (i, leaf) in
+                              conn.execute("SELECT id, leaf FROM queryLeaf;"))
+
+    def _leaf_id(self, leaf):
+        i = self._leaf_ids.get(leaf)
+        if i is None:
+            i = self._conn.execute("INSERT INTO queryLeaf(leaf) VALUES (?);",
+                                   (leaf,)).lastrowid
+            self._conn.executemany("INSERT INTO queryTrigram(trigram, leaf) VALUES (?, ?);",
+                                   ((trigram, i,) for trigram in trigrams(leaf)))
+            self._leaf_ids[leaf] = i
+        return i
+
+    def add(self, rows):
+        """Adds (id, name) rows of searchIndex"""
+        self._conn.executemany(
+            "INSERT OR REPLACE INTO queryName(row, name, leaf) VALUES (?, ?, ?);",
+            ((row_id, name, self._leaf_id(leaf_of(name)),)
+             for (row_id, name) in ((row_id, normalize(name)) for (row_id, name) in rows)))
+
+
+def build_query_tables(conn):
+    """Creates side tables for all rows of searchIndex"""
+    for statement in SCHEMA:
+        conn.execute(statement)
+    TableWriter(conn).add(conn.execute("SELECT id, name FROM searchIndex;").fetchall())
+    for statement in INDEXES:
+        conn.execute(statement)
+
+
+def remove_query_rows(conn, rows):
+    """Removes (name, type, path) rows, which are still in searchIndex,
+    from side tables. Leaves are kept, they're cheap and might be
+    used again"""
+    conn.executemany("DELETE FROM queryName WHERE row IN "
+                     "(SELECT id FROM searchIndex WHERE name = ? AND type = ? AND path = ?);",
+                     rows)
+
+
+def add_query_rows(conn, rows):
+    """Adds (name, type, path) rows, which are already in searchIndex,
+    to side tables"""
+    ids = []
+    for row in rows:
+        ids.extend(conn.execute("SELECT id, name FROM searchIndex "
+                                "WHERE name = ? AND type = ? AND path = ?;", row))
+    TableWriter(conn).add(ids)
+
+
+class LRUCache(object):
+    """Keeps results of size most recently used queries"""
+    def __init__(self, size=DEFAULT_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+
+    def get(self, key):
+        value = self._items.pop(key, None)
+        if value is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._items[key] = value
+        return value
+
+    def put(self, key, value):
+        self._items.pop(key, None)
+        self._items[key] = value
+        if len(self._items) > self.size:
+            self._items.popitem(last=False)
+
+    def clear(self):
+        self._items.clear()
+
+
+class QueryIndex(object):
+    """Queries docSet.dsidx at path. Side tables are created if they
+    are missing, so index should be writable the first time"""
+    def __init__(self, path, cache_size=DEFAULT_CACHE_SIZE):
+        self._conn = sqlite3.connect(path)
+        if not has_query_tables(self._conn):
+            log.info("Building query tables in %s", path)
+            with self._conn:
+                build_query_tables(self._conn)
+        self.cache = LRUCache(cache_size)
+        self.times = []
+        self._leaves = None
+
+    def close(self):
+        self._conn.close()
+
+    def search(self, query, mode="prefix", types=None, limit=DEFAULT_LIMIT):
+        """Returns [(name, type, path)] of rows matching query, best
+        first. types limits results to given Dash types"""
+        if mode not in MODES:
+            raise ValueError("Unknown query mode %s, expected one of %s" %
+                             (mode, ", ".join(MODES)))
+        start = time.time()
+        query = normalize(query.strip())
+        key = (mode, query, tuple(sorted(types or ())), limit,)
+        results = self.cache.get(key)
+        if results is None:
+            results = getattr(self, "_" + mode)(query, types, limit) if query else []
+            self.cache.put(key, results)
+        self.times.append(time.time() - start)
+        return results
+
+    def stats(self):
+        """Latency of queries so far in ms and cache hit rate"""
+        times = [t * 1000.0 for t in self.times]
+        total = self.cache.hits + self.cache.misses
+        return {
+            'queries': len(times),
+            'p50_ms': timing.percentile(times, 50) if times else 0.0,
+            'p99_ms': timing.percentile(times, 99) if times else 0.0,
+            'cache_hit_rate': float(self.cache.hits) / total if total else 0.0
+        }
+
+    def _rows(self, where, args, types, order="length(n.name), n.name",
+              order_args=(), limit=None):
+        sql = ("SELECT s.name, s.type, s.path, n.leaf FROM queryName n "
+               "JOIN searchIndex s ON s.id = n.row WHERE (%s)" % where)
+        args = list(args)
+        if types:
+            sql += " AND s.type IN (%s)" % ", ".join("?" * len(types))
+            args.extend(types)
+        sql += " ORDER BY %s" % order
+        args.extend(order_args)
+        if limit is not None:
+            sql += " LIMIT ?"
+            args.append(limit)
+        return self._conn.execute(sql + ";", args).fetchall()
+
+    def _exact(self, query, types, limit):
+        return [row[:3] for row in self._rows(
+            "n.name = ? OR n.leaf = (SELECT id FROM queryLeaf WHERE leaf = ?)",
+            (query, query,), types, limit=limit)]
+
+    def _prefix(self, query, types, limit):
+        # Exact matches of last part go first
+        return [row[:3] for row in self._rows(
+            "n.name >= ? AND n.name < ? OR n.leaf IN "
+            "(SELECT id FROM queryLeaf WHERE leaf >= ? AND leaf < ?)",
+            (query, query + MAX_CHAR, query, query + MAX_CHAR,), types,
+            "n.leaf IS NOT (SELECT id FROM queryLeaf WHERE leaf = ?), length(n.name), n.name",
+            (query,), limit)]
+
+    def _leaf_list(self):
+        if self._leaves is None:
+            self._leaves = self._conn.execute("SELECT id, leaf FROM queryLeaf;").fetchall()
+        return self._leaves
+
+    def _fuzzy(self, query, types, limit):
+        scores = {}
+        # Subsequence of leaf
+        pattern = re.compile(".*?".join(re.escape(c) for c in query))
+        for (leaf_id, leaf) in self._leaf_list():
+            if pattern.search(leaf):
+                # Substrings and denser matches are better
+                scores[leaf_id] = (2.0 if query in leaf else 1.0) + \
+                    float(len(query)) / len(leaf)
+
+        # Leaves with typos still share trigrams with query
+        query_trigrams = trigrams(query)
+        if query_trigrams:
+            for (leaf_id, leaf, common) in self._conn.execute(
+                    "SELECT l.id, l.leaf, COUNT(*) FROM queryTrigram t "
+                    "JOIN queryLeaf l ON l.id = t.leaf WHERE t.trigram IN (%s) "
+                    "GROUP BY l.id HAVING COUNT(*) * 2 >= ?;" %
+                    ", ".join("?" * len(query_trigrams)),
+                    list(query_trigrams) + [len(query_trigrams)]):
+                if leaf_id not in scores:
+                    scores[leaf_id] = float(common) / max(len(query_trigrams),
+                                                          len(trigrams(leaf)))
+
+        results = []
+        best = sorted(scores, key=lambda leaf_id: -scores[leaf_id])
+        # Rows are fetched for best leaves first until there are enough
+        for i in xrange(0, len(best), FUZZY_CHUNK):
+            chunk = best[i:i + FUZZY_CHUNK]
+            rows = self._rows("n.leaf IN (%s)" % ", ".join("?" * len(chunk)),
+                              chunk, types)
+            rows.sort(key=lambda row: (-scores[row[3]], len(row[0]), row[0],))
+            results.extend(row[:3] for row in rows[:limit - len(results)])
+            if len(results) >= limit:
+                break
+        return results
@@ -1,6 +1,10 @@
+import errno
 import logging as log
 import os
 import re
+from predicate import RelPath
+import time
+import timing
 
 
 def matches(ctx, predicates):
@@ -11,24 +15,261 @@ def matches(ctx, predicates):
     return True
 
 
-def rule_for_file(rules, ctx):
-    for rule in rules:
+def rule_index_for_file(rules, ctx):
+    """Returns index of the first matching rule or None"""
+    if isinstance(rules, RuleTable):
+        return rules.lookup(ctx)
+
+    for (i, rule) in enumerate(rules):
         if matches(ctx, rule[:-1]):
-            return rule[-1]
+            return i
 
     return None
 
 
+def rule_for_file(rules, ctx):
+    i = rule_index_for_file(rules, ctx)
+    if i is None:
+        return None
+    return rules[i][-1]
+
+
+# Patterns with these can't be safely joined into alternation:
+# inline flags are global in Python 2, group references and
+# names would point to wrong groups
+UNSAFE_PATTERN_RE = re.compile(r'\(\?[aiLmsux]|\(\?P|\\[0-9]')
+
+# Literal extension(s) required by pattern, i.e. \.html$ or \.(t|v|m)$
+EXT_PATTERN_RE = re.compile(r'(?<!\\)\\\.\(?([a-zA-Z0-9]+(?:\|[a-zA-Z0-9]+)*)\)?\$$')
+
+ANY = object()
+
+
+def has_top_level_alternation(pattern):
+    depth = 0
+    in_class = False
+    escaped = False
+    for ch in pattern:
+        if escaped:
+            escaped = False
+        elif ch == '\\':
+            escaped = True
+        elif in_class:
+            in_class = ch != ']'
+        elif ch == '[':
+            in_class = True
+        elif ch == '(':
+            depth += 1
+        elif ch == ')':
+            depth -= 1
+        elif ch == '|' and depth == 0:
+            return True
+    return False
+
+
+def required_exts(pattern):
+    """Returns set of extensions a path must have to match
+    pattern or None if it can't be figured out"""
+    m = EXT_PATTERN_RE.search(pattern)
+    if not m or has_top_level_alternation(pattern):
+        return None
+    return set(m.group(1).split("|"))
+
+
+def file_ext(path):
+    base = os.path.basename(path)
+    pos = base.rfind('.')
+    return base[pos + 1:] if pos >= 0 else ''
+
+
+class CompiledRule(object):
+    """Static info about a rule: dirname it is bound to, extensions
+    it could match and a regex fragment equivalent to its predicates
+    (None if predicates can't be expressed as regex)"""
+    def __init__(self, index, rule):
+        self.index = index
+        self.dirname = ANY
+        self.exts = None
+        self.fragment = ""
+
+        for pred in rule[:-1]:
+            if not isinstance(pred, RelPath):
+                self.fragment = None
+                continue
+
+            for (key, value) in pred.spec.items():
+                if key == "dirname":
+                    if self.dirname is not ANY and self.dirname != value:
+                        # Can't be bound to 2 dirs at once
+                        self.exts = set()
+                    self.dirname = value
+                elif key == "matches":
+                    exts = required_exts(value)
+                    if exts is not None:
+                        self.exts = exts if self.exts is None else self.exts & exts
+                    if self.fragment is not None:
+                        if UNSAFE_PATTERN_RE.search(value):
+                            self.fragment = None
+                        else:
+                            self.fragment += r"(?=[\s\S]*?(?:%s))" % value
+                elif key == "startswith":
+                    if self.fragment is not None:
+                        self.fragment += r"(?=%s)" % re.escape(value)
+                else:
+                    # Unknown predicate, evaluate it as is
+                    self.fragment = None
+
+    def could_match(self, dirname, ext):
+        if self.dirname is not ANY and self.dirname != dirname:
+            return False
+        return self.exts is None or ext in self.exts
+
+
+class RuleTable(object):
+    """Rules compiled into a dispatch table with the same
+    first match semantics.
+
+    Rules are split into buckets by (dirname, extension) of a
+    file, every bucket contains only rules which could match.
+    Consecutive rules in a bucket, which are expressible as
+    regexes, are joined into a single alternation, so usually
+    a file is matched with a single regex call.
+
+    Tables of docset.backends know their docset type and
+    fingerprint and are pickled as a type name, so they are
+    compiled once per process."""
+    def __init__(self, rules):
+        self.rules = rules
+        self.backend = None
+        self.fingerprint = None
+        self._compiled = [CompiledRule(i, rule) for (i, rule) in enumerate(rules)]
+        self._buckets = {}
+        self._warn_duplicates()
+
+    def __reduce__(self):
+        if self.backend is None:
+            return (RuleTable, (self.rules,))
+        from backends import table_for
+        return (table_for, (self.backend,))
+
+    def __len__(self):
+        return len(self.rules)
+
+    def __getitem__(self, i):
+        return self.rules[i]
+
+    def _warn_duplicates(self):
+        seen = {}
+        for (i, rule) in enumerate(self.rules):
+            try:
+                key = tuple(rule)
+                if key in seen:
+                    log.warn("Rule %d duplicates rule %d and will never match", i, seen[key])
+                else:
+                    seen[key] = i
+            except TypeError:
+                # Unhashable predicate, can't compare
+                pass
+
+    def _bucket(self, dirname, ext):
+        segments = []
+        group = []
+
+        def close_group():
+            if group:
+                alternation = "|".join("%s(?P<r%d>)" % (c.fragment, c.index)
+                                       for c in group)
+                segments.append(re.compile("(?:%s)" % alternation))
+                del group[:]
+
+        for c in self._compiled:
+            if not c.could_match(dirname, ext):
+                continue
+            if c.fragment is None:
+                close_group()
+                segments.append(c.index)
+            else:
+                group.append(c)
+        close_group()
+        return segments
+
+    def lookup(self, ctx):
+        """Returns index of the first matching rule or None"""
+        rel_path = ctx['rel_path']
+        key = (os.path.dirname(rel_path), file_ext(rel_path),)
+        segments = self._buckets.get(key)
+        if segments is None:
+            segments = self._bucket(*key)
+            self._buckets[key] = segments
+
+        for segment in segments:
+            if isinstance(segment, int):
+                if matches(ctx, self.rules[segment][:-1]):
+                    return segment
+            else:
+                m = segment.match(rel_path)
+                if m:
+                    return int(m.lastgroup[1:])
+
+        return None
+
+    def report(self, hits):
+        """Returns lines with hits per rule, followed by rules which
+        never matched. hits is a list of counters per rule"""
+        lines = []
+        unused = []
+        for (i, rule) in enumerate(self.rules):
+            action = rule[-1]
+            name = getattr(action, '__name__', repr(action))
+            desc = "%d: %s -> %s" % (i, ", ".join(map(repr, rule[:-1])) or "*", name,)
+            lines.append("%8d  %s" % (hits[i], desc,))
+            if not hits[i]:
+                unused.append(desc)
+
+        if unused:
+            lines.append("Never matched:")
+            lines.extend("  " + desc for desc in unused)
+        return lines
+
+
+def compile_rules(rules):
+    """Compiles list of rules into RuleTable, tables are returned as is"""
+    if isinstance(rules, RuleTable):
+        return rules
+    return RuleTable(rules)
+
+
+def ensure_dir(dest_dir):
+    if not os.path.exists(dest_dir):
+        log.info("Creating %s", dest_dir)
+        try:
+            os.makedirs(dest_dir)
+        except OSError as e:
+            # Might be already created by another worker
+            if e.errno != errno.EEXIST:
+                raise
+
+
 def process_file_rules(rules, ctx):
     """Rules are checked until first match.
        If there are no patterns - it is a default rule,
-       which will be executed anyway"""
-    fn = rule_for_file(rules, ctx)
+       which will be executed anyway.
+
+       Returns index of matched rule"""
+    i = rule_index_for_file(rules, ctx)
+    fn = rules[i][-1] if i is not None else None
     if fn:
-        dest_dir = os.path.dirname(ctx['dest_path'])
+        ensure_dir(os.path.dirname(ctx['dest_path']))
 
-        if not os.path.exists(dest_dir):
-            log.info("Creating %s", dest_dir)
-            os.makedirs(dest_dir)
+        profiler = timing.current()
+        if profiler is None:
+            fn(ctx)
+        else:
+            start = time.time()
+            fn(ctx)
+            end = time.time()
+            name = "action:%s" % getattr(fn, '__name__', 'unknown')
+            profiler.add(name, start, end, {'file': ctx['rel_path']})
+            profiler.add_file(ctx['rel_path'], end - start)
 
-        fn(ctx)
+    return i
@@ -23,7 +23,40 @@ def path_with_ref(path, ref):
         return path
 
 
-@cached_html
+# Splits declaration file name into (type, name),
+# i.e. struct.Vec.html -> ("struct", "Vec")
+def decl_parts(rel_path):
+    name, _ = os.path.splitext(os.path.basename(rel_path))
+    name_parts = name.split('.')
+    if len(name_parts) < 2:
+        return None
+    return tuple(name_parts)
+
+
+def guide_filters(ctx):
+    if ctx['rel_path'] == 'index.html':
+        return ([], [])
+    return (index_rules.guide_titles(), [])
+
+
+def module_filters(ctx):
+    return ([], toc_rules.by_type("mod"))
+
+
+def decl_filters(ctx):
+    parts = decl_parts(ctx['rel_path'])
+    if not parts:
+        return ([], [])
+
+    ty = parts[0]
+    toc = toc_rules.by_type(ty)
+    # Type could turn out to be an enum
+    if ty == "type":
+        toc = toc + toc_rules.by_type("enum")
+    return (index_rules.by_type(ty), toc)
+
+
+@cached_html(filters=guide_filters)
 def add_guide(ctx, tree):
     """
     This one should work only for nigthly builds
@@ -42,7 +75,7 @@ def add_guide(ctx, tree):
                        "gd", ctx['rel_path'], to_dash_type)
 
 
-@cached_html
+@cached_html(filters=module_filters)
 def add_module(ctx, tree):
     fqn_prefix = os.path.dirname(ctx['rel_path']).replace(os.sep, "::")
     ctx['idx'].add(fqn_prefix, "mod", ctx['rel_path'], to_dash_type)
@@ -50,17 +83,16 @@ def add_module(ctx, tree):
                lambda x: to_dash_type(x, x))
 
 
-@cached_html
+@cached_html(filters=decl_filters)
 def add_decl_html(ctx, tree):
     idx = ctx['idx']
 
     rel_path = ctx['rel_path']
-    name, _ = os.path.splitext(os.path.basename(rel_path))
     dirname = os.path.dirname(rel_path)
 
     fqn_prefix = dirname.replace(os.sep, "::")
-    name_parts = name.split('.')
-    if len(name_parts) < 2:
+    name_parts = decl_parts(rel_path)
+    if not name_parts:
         log.error("Unexpected HTML file: %s" % rel_path)
         return
     ty, name = name_parts
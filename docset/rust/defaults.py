@@ -43,9 +43,6 @@ RUST_STD_RULES = [
     [rel_path(dirname="book"), rel_path(matches='index\\.html$'), add_guide],
     [rel_path(dirname="book"), rel_path(matches='.*\\.html$'), cp_file],
 
-    [rel_path(dirname="book"), rel_path(matches='index\\.html$'), add_guide],
-    [rel_path(dirname="book"), rel_path(matches='.*\\.html$'), cp_file],
-
     [rel_path(dirname="nomicon"), rel_path(matches='index\\.html$'), add_guide],
     [rel_path(dirname="nomicon"), rel_path(matches='.*\\.html$'), cp_file],
 
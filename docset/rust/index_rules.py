@@ -8,8 +8,11 @@ def node_with_id_noref(node):
     parts = node.attrib["id"].split(".")
     return (parts[1], parts[0], None,)
 
+# Filters marked as streamable use only node itself, so they
+# could be applied while page is parsed (see extract.stream_nodes)
 METHOD_FILTER = {"xpath": '//*[@class="method"]',
-                 "fn": node_with_id_ref}
+                 "fn": node_with_id_ref,
+                 "streamable": True}
 
 VARIANT_FILTER = {"xpath": '//*[@class="variants"]/following-sibling::table[1]/tr/td[1]',
                   "fn": node_with_id_noref}
@@ -18,7 +21,8 @@ FIELD_FILTER = {"xpath": '//*[@class="fields"]/following-sibling::table/tr/td[1]
                 "fn": node_with_id_noref}
 
 GUIDE_TITLE_FILTER = {"xpath": '//h1[@class="title"]',
-                      "fn": lambda node: (node.text, None, None,)}
+                      "fn": lambda node: (node.text, None, None,),
+                      "streamable": True}
 
 # Trait implementers filter
 #{"type": "trait_impls",
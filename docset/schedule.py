@@ -0,0 +1,147 @@
+import logging as log
+import pickle
+import Queue
+import traceback
+
+"""Feeds files to a worker pool, biggest first.
+
+Items are read from source in windows, every window is sorted by
+size, biggest first, and split into chunks (up to chunk_size items
+and chunk_bytes bytes), so big files don't end up on one worker at
+the end of build and small ones still go in batches. Results are
+returned in source order through a reorder buffer. The first window
+is a single chunk and every next one is twice as big up to window
+items, so workers get files as soon as a few of them are read, even
+if source is a slow download.
+
+Chunks are submitted with apply_async by the thread of the build
+itself and results come back to its own queue, so builds in several
+threads share a pool and run concurrently. Build stops reading
+source while window items are sent but not yet returned in order.
+Items of the window being read are the only ones which could wait
+for earlier items, so the earliest one is always sent and the build
+can't stall, while memory stays flat regardless of the number of
+files"""
+
+DEFAULT_WINDOW = 1024
+
+DEFAULT_CHUNK_SIZE = 16
+
+DEFAULT_CHUNK_BYTES = 256 * 1024
+
+# Waits for results are split, as Python 2 doesn't interrupt
+# waits without timeout on Ctrl-C
+WAIT_TIMEOUT = 1.0
+
+
+def windows(sized_items, first, size):
+    """Splits (size, item) pairs into lists, the first one has
+    first pairs and every next one is twice as big up to size"""
+    window = []
+    limit = min(first, size)
+    for pair in sized_items:
+        window.append(pair)
+        if len(window) >= limit:
+            yield window
+            window = []
+            limit = min(limit * 2, size)
+    if window:
+        yield window
+
+
+def call_chunk(fn, chunk):
+    """Runs fn in worker. Pool of Python 2 has no error callback for
+    apply_async, so errors are returned as (error, traceback)"""
+    try:
+        return (None, fn(chunk),)
+    except Exception as e:
+        try:
+            pickle.dumps(e, pickle.HIGHEST_PROTOCOL)
+        except Exception:
+            e = RuntimeError("%s: %s" % (type(e).__name__, e,))
+        return (e, traceback.format_exc(),)
+
+
+class Scheduler(object):
+    """Runs fn over sized_items, (size, item) pairs, with pool.
+    fn gets a list of (seq, item) and returns a list of
+    (seq, result)"""
+    def __init__(self, sized_items, window=DEFAULT_WINDOW,
+                 chunk_size=DEFAULT_CHUNK_SIZE, chunk_bytes=DEFAULT_CHUNK_BYTES):
+        self.sized_items = sized_items
+        self.window = max(1, window)
+        self.chunk_size = chunk_size
+        self.chunk_bytes = chunk_bytes
+        self.peak_pending = 0
+
+    def chunks(self):
+        """Yields lists of (seq, item)"""
+        seq = 0
+        for window in windows(self.sized_items, self.chunk_size, self.window):
+            numbered = [(size, seq + i, item) for (i, (size, item)) in enumerate(window)]
+            seq += len(window)
+            del window
+            numbered.sort(key=lambda x: (-x[0], x[1]))
+
+            chunk = []
+            chunk_bytes = 0
+            for (size, i, item) in numbered:
+                if chunk and (len(chunk) >= self.chunk_size or
+                              chunk_bytes + size > self.chunk_bytes):
+                    yield chunk
+                    chunk = []
+                    chunk_bytes = 0
+                chunk.append((i, item,))
+                chunk_bytes += size
+            if chunk:
+                yield chunk
+
+    def results(self, pool, fn):
+        """Yields results of fn for items in source order"""
+        done = Queue.Queue()
+        buffered = {}
+        # Items sent but not yielded yet and chunks not returned yet
+        state = {'next': 0, 'pending': 0, 'running': 0}
+
+        def receive(block):
+            while True:
+                try:
+                    (error, results) = done.get(block, WAIT_TIMEOUT)
+                    break
+                except Queue.Empty:
+                    if not block:
+                        raise
+            state['running'] -= 1
+            if error is not None:
+                log.error("Worker failed:\n%s", results)
+                raise error
+            for (seq, result) in results:
+                buffered[seq] = result
+
+        def ready():
+            while state['next'] in buffered:
+                result = buffered.pop(state['next'])
+                state['next'] += 1
+                state['pending'] -= 1
+                yield result
+
+        for chunk in self.chunks():
+            pool.apply_async(call_chunk, (fn, chunk,), callback=done.put)
+            state['running'] += 1
+            state['pending'] += len(chunk)
+            self.peak_pending = max(self.peak_pending, state['pending'])
+
+            # Returned chunks are taken without waiting, unless
+            # window is full and there is something to wait for
+            while True:
+                try:
+                    receive(state['pending'] >= self.window and state['running'] > 0)
+                except Queue.Empty:
+                    break
+                for result in ready():
+                    yield result
+
+        while state['running'] > 0:
+            receive(True)
+            for result in ready():
+                yield result
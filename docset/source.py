@@ -0,0 +1,123 @@
+import logging as log
+import os
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+"""Sources provide files to process as tuples
+(rel_path, full_path, data), where either full_path points
+to a file on disk or data contains already read contents.
+
+sized_files yields (size, item) pairs, sizes are used to
+schedule big files first when files are processed by workers.
+Sizes cost a stat per file, so files doesn't get them"""
+
+
+def walk_scandir(path, sizes=True):
+    """Yields (full_path, size) of files under path in the same
+    order as sorted os.walk, directory entries are read with
+    scandir, so file types come from the directory listing.
+    Directories are read one at a time, so memory doesn't depend
+    on size of tree. If sizes is False, sizes are None"""
+    entries = sorted((entry.name, entry) for entry in scandir(path))
+    dirs = []
+    for (name, entry) in entries:
+        try:
+            is_dir = entry.is_dir()
+        except OSError:
+            is_dir = False
+        if is_dir:
+            # The same as os.walk, links to dirs aren't followed
+            if not entry.is_symlink():
+                dirs.append(entry.path)
+            continue
+        size = None
+        if sizes:
+            try:
+                size = entry.stat().st_size
+            except OSError:
+                # Broken link, processing reports it
+                size = 0
+        yield (entry.path, size,)
+    del entries
+
+    for dir_path in dirs:
+        for item in walk_scandir(dir_path, sizes):
+            yield item
+
+
+def walk_listdir(path, sizes=True):
+    """walk_scandir without scandir"""
+    for root, dirnames, filenames in os.walk(path):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            full_path = os.path.join(root, filename)
+            size = None
+            if sizes:
+                try:
+                    size = os.path.getsize(full_path)
+                except OSError:
+                    size = 0
+            yield (full_path, size,)
+
+
+class DirSource(object):
+    """Files from a directory, in a stable order"""
+    def __init__(self, path):
+        self.path = path
+
+    def _walk(self, sizes):
+        walk = walk_scandir if scandir is not None else walk_listdir
+        for (full_path, size) in walk(self.path, sizes):
+            yield (size, (os.path.relpath(full_path, self.path), full_path, None,),)
+
+    def sized_files(self):
+        return self._walk(True)
+
+    def files(self):
+        for (_, item) in self._walk(False):
+            yield item
+
+
+class TarSource(object):
+    """Files from an opened tarfile under prefix. Members are read
+    one by one as they are decompressed, so tar could be opened
+    in stream mode, i.e. 'r|gz'"""
+    def __init__(self, tar, prefix):
+        self.tar = tar
+        self.prefix = prefix.rstrip("/") + "/"
+
+    def sized_files(self):
+        for item in self.files():
+            yield (len(item[2]), item,)
+
+    def files(self):
+        for info in self.tar:
+            if not info.name.startswith(self.prefix):
+                continue
+
+            if info.isfile():
+                rel_path = os.path.relpath(info.name, self.prefix)
+                yield (rel_path, None, self.tar.extractfile(info).read(),)
+            elif not info.isdir():
+                log.warn("Skipping unsupported tar member %s", info.name)
+
+
+def sized_files(source):
+    """(size, item) pairs of source, sources without sizes
+    get size 0"""
+    if hasattr(source, 'sized_files'):
+        return source.sized_files()
+    return ((0, item,) for item in source.files())
+
+
+def source_for(src):
+    """Wraps a directory path into source, passes sources as is"""
+    if isinstance(src, basestring):
+        return DirSource(src)
+    return src
@@ -0,0 +1,98 @@
+from array import array
+import sys
+
+"""Compact storage of index rows.
+
+std docs have hundreds of thousands of rows and most of their
+strings repeat: FQN prefixes (std::collections::HashMap), method
+names (new, clone), pages and Dash types. SymbolTable keeps every
+unique string once and a row as 5 integers in arrays:
+
+- name is split at the last "::" into prefix and leaf
+- path is split at "#" into page and anchor
+- Dash type is a small code
+
+so rows take ~17 bytes plus unique strings"""
+
+NO_STRING = -1
+
+
+def split_at(s, sep):
+    pos = s.rfind(sep)
+    if pos < 0:
+        return (None, s,)
+    return (s[:pos], s[pos + len(sep):],)
+
+
+class SymbolTable(object):
+    def __init__(self):
+        self._types = []
+        self._type_codes = {}
+        self.peak_memory = 0
+        self.clear()
+
+    def clear(self):
+        """Removes all rows and strings, peak memory is kept"""
+        self._strings = []
+        self._string_ids = {}
+        self._strings_size = 0
+        self._prefixes = array('i')
+        self._leaves = array('i')
+        self._codes = array('B')
+        self._pages = array('i')
+        self._anchors = array('i')
+
+    def __len__(self):
+        return len(self._codes)
+
+    def _intern(self, s):
+        if s is None:
+            return NO_STRING
+        i = self._string_ids.get(s)
+        if i is None:
+            i = len(self._strings)
+            self._strings.append(s)
+            self._string_ids[s] = i
+            self._strings_size += sys.getsizeof(s)
+        return i
+
+    def _type_code(self, dash_ty):
+        code = self._type_codes.get(dash_ty)
+        if code is None:
+            code = len(self._types)
+            if code > 255:
+                raise ValueError("Too many types, can't add %s" % dash_ty)
+            self._types.append(dash_ty)
+            self._type_codes[dash_ty] = code
+        return code
+
+    def add(self, name, dash_ty, path):
+        (prefix, leaf) = split_at(name, "::")
+        (page, anchor) = split_at(path, "#")
+        self._prefixes.append(self._intern(prefix))
+        self._leaves.append(self._intern(leaf))
+        self._codes.append(self._type_code(dash_ty))
+        self._pages.append(self._intern(page))
+        self._anchors.append(self._intern(anchor))
+
+    def _join(self, prefix, sep, rest):
+        if prefix == NO_STRING:
+            return self._strings[rest]
+        return self._strings[prefix] + sep + self._strings[rest]
+
+    def rows(self):
+        """Yields rows as (name, type, path) in order of adding"""
+        for i in xrange(len(self._codes)):
+            yield (self._join(self._prefixes[i], "::", self._leaves[i]),
+                   self._types[self._codes[i]],
+                   self._join(self._pages[i], "#", self._anchors[i]),)
+
+    def memory(self):
+        """Approximate size of table in bytes, also updates peak"""
+        size = self._strings_size + \
+            sys.getsizeof(self._strings) + sys.getsizeof(self._string_ids)
+        for arr in (self._prefixes, self._leaves, self._codes,
+                    self._pages, self._anchors):
+            size += arr.buffer_info()[1] * arr.itemsize
+        self.peak_memory = max(self.peak_memory, size)
+        return size
@@ -0,0 +1,137 @@
+import heapq
+import json
+import os
+import threading
+import time
+
+"""Build instrumentation. Code marks phases with
+
+    with timing.phase("html.parse"):
+        ...
+
+which costs a single call if profiling is disabled. Profiler is
+enabled per thread, so concurrent builds don't mix their data.
+Workers get a profiler for every file of a profiled build and send
+its data to the build, which merges it"""
+
+
+class NullPhase(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        return False
+
+NULL_PHASE = NullPhase()
+
+
+class Phase(object):
+    __slots__ = ('profiler', 'name', 'args', 'start')
+
+    def __init__(self, profiler, name, args):
+        self.profiler = profiler
+        self.name = name
+        self.args = args
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *args):
+        self.profiler.add(self.name, self.start, time.time(), self.args)
+        return False
+
+
+class Profiler(object):
+    """Collects count and cumulative time per phase, slowest files
+    and, if trace is True, events for Chrome trace format"""
+    def __init__(self, slowest=10, trace=False):
+        self.slowest = slowest
+        self.trace = trace
+        self._reset()
+
+    def _reset(self):
+        self.totals = {}
+        self.files = []
+        self.events = [] if self.trace else None
+
+    def add(self, name, start, end, args=None):
+        total = self.totals.get(name)
+        if total is None:
+            total = [0, 0.0]
+            self.totals[name] = total
+        total[0] += 1
+        total[1] += end - start
+
+        if self.events is not None:
+            event = {'name': name, 'ph': 'X', 'pid': os.getpid(), 'tid': 0,
+                     'ts': int(start * 1e6), 'dur': int((end - start) * 1e6)}
+            if args:
+                event['args'] = args
+            self.events.append(event)
+
+    def add_file(self, rel_path, seconds):
+        item = (seconds, rel_path,)
+        if len(self.files) < self.slowest:
+            heapq.heappush(self.files, item)
+        else:
+            heapq.heappushpop(self.files, item)
+
+    def drain(self):
+        """Returns collected data and starts from scratch"""
+        data = (self.totals, self.files, self.events,)
+        self._reset()
+        return data
+
+    def merge(self, data):
+        (totals, files, events) = data
+        for (name, (count, seconds)) in totals.items():
+            total = self.totals.setdefault(name, [0, 0.0])
+            total[0] += count
+            total[1] += seconds
+        for (seconds, rel_path) in files:
+            self.add_file(rel_path, seconds)
+        if self.events is not None and events:
+            self.events.extend(events)
+
+    def summary(self):
+        """Returns lines with per phase totals and slowest files"""
+        lines = ["%-32s %10s %10s %10s" % ("phase", "count", "total, s", "avg, ms")]
+        for (name, (count, seconds)) in sorted(self.totals.items(),
+                                               key=lambda i: -i[1][1]):
+            lines.append("%-32s %10d %10.3f %10.3f" % (name, count, seconds,
+                                                        seconds * 1000.0 / count))
+        if self.files:
+            lines.append("Slowest files:")
+            for (seconds, rel_path) in sorted(self.files, reverse=True):
+                lines.append("%10.3fs  %s" % (seconds, rel_path,))
+        return lines
+
+    def save_trace(self, path):
+        with open(path, "wt") as f:
+            json.dump({'traceEvents': self.events or [],
+                       'displayTimeUnit': 'ms'}, f)
+
+
+_local = threading.local()
+
+
+def percentile(values, p):
+    """Returns p-th percentile of values, nearest rank"""
+    values = sorted(values)
+    return values[int(round((len(values) - 1) * p / 100.0))]
+
+
+def enable(profiler):
+    _local.profiler = profiler
+
+
+def current():
+    return getattr(_local, 'profiler', None)
+
+
+def phase(name, args=None):
+    profiler = getattr(_local, 'profiler', None)
+    if profiler is None:
+        return NULL_PHASE
+    return Phase(profiler, name, args)
@@ -1,6 +1,13 @@
 from lxml.html.builder import A, CLASS
+import timing
+
 
 def inject_toc(tree, rules, ty_map_fn = None):
+    with timing.phase("inject_toc"):
+        return _inject_toc(tree, rules, ty_map_fn)
+
+
+def _inject_toc(tree, rules, ty_map_fn):
     modified = False
 
     for rule in rules:
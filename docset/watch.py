@@ -0,0 +1,165 @@
+import ctypes
+import ctypes.util
+import errno
+import logging as log
+import os
+import select
+import struct
+import time
+
+"""Live docset updates: source dir is watched for changes, which
+are applied to an already built docset in place.
+
+Changes are detected with inotify on Linux or by polling on other
+systems. Watchers yield batches of changed paths once changes stop
+for debounce seconds, as cargo doc rewrites many files at once"""
+
+# From sys/inotify.h
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ISDIR = 0x40000000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_CREATE | \
+    IN_DELETE | IN_DELETE_SELF
+
+EVENT_HEADER = struct.Struct("iIII")
+
+DEFAULT_DEBOUNCE = 0.5
+
+
+class InotifyWatcher(object):
+    """Watches dir tree with inotify. Batches are sets of paths
+    relative to root, which might be files or dirs, or None if
+    events were lost and everything should be checked"""
+    def __init__(self, root):
+        libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+        self._add_watch = libc.inotify_add_watch
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        self.root = root
+        self._fd = libc.inotify_init1(IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        self._dirs = {}
+        self._watch_tree(root)
+
+    def _watch_tree(self, path):
+        for root, dirnames, filenames in os.walk(path):
+            wd = self._add_watch(self._fd, root, WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                # Dir might be removed in the meantime
+                if e != errno.ENOENT:
+                    raise OSError(e, "Can't watch %s: %s" % (root, os.strerror(e)))
+            else:
+                self._dirs[wd] = root
+
+    def _read_events(self, changes):
+        """Reads available events into changes, returns
+        None if events were lost"""
+        data = os.read(self._fd, 64 * 1024)
+        offset = 0
+        while offset < len(data):
+            (wd, mask, cookie, length) = EVENT_HEADER.unpack_from(data, offset)
+            offset += EVENT_HEADER.size
+            name = data[offset:offset + length].rstrip("\0")
+            offset += length
+
+            if mask & IN_Q_OVERFLOW:
+                return None
+            if mask & IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+
+            dirname = self._dirs.get(wd)
+            if dirname is None:
+                continue
+            path = os.path.join(dirname, name) if name else dirname
+            if mask & IN_ISDIR and mask & (IN_CREATE | IN_MOVED_TO):
+                # Files could be created before dir is watched,
+                # whole dir is reported
+                self._watch_tree(path)
+            changes.add(os.path.relpath(path, self.root))
+        return changes
+
+    def batches(self, debounce=DEFAULT_DEBOUNCE):
+        while True:
+            select.select([self._fd], [], [])
+            changes = set()
+            while changes is not None:
+                changes = self._read_events(changes)
+                (ready, _, _) = select.select([self._fd], [], [], debounce)
+                if not ready:
+                    break
+            if changes is None:
+                # Drains the rest of events
+                while select.select([self._fd], [], [], debounce)[0]:
+                    os.read(self._fd, 64 * 1024)
+            yield changes
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PollingWatcher(object):
+    """Watches dir tree by comparing mtime and size of files
+    every interval seconds"""
+    def __init__(self, root, interval=1.0):
+        self.root = root
+        self.interval = interval
+        self._snapshot = self._scan()
+
+    def _scan(self):
+        snapshot = {}
+        for root, dirnames, filenames in os.walk(self.root):
+            for name in filenames:
+                path = os.path.join(root, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                snapshot[os.path.relpath(path, self.root)] = (st.st_mtime, st.st_size,)
+        return snapshot
+
+    def _changes(self):
+        snapshot = self._scan()
+        changes = set(rel_path for (rel_path, stamp) in snapshot.items()
+                      if self._snapshot.get(rel_path) != stamp)
+        changes.update(rel_path for rel_path in self._snapshot
+                       if rel_path not in snapshot)
+        self._snapshot = snapshot
+        return changes
+
+    def batches(self, debounce=DEFAULT_DEBOUNCE):
+        while True:
+            time.sleep(self.interval)
+            changes = self._changes()
+            if not changes:
+                continue
+            while True:
+                time.sleep(max(debounce, self.interval))
+                more = self._changes()
+                if not more:
+                    break
+                changes.update(more)
+            yield changes
+
+    def close(self):
+        pass
+
+
+def create_watcher(root):
+    """Returns inotify watcher if it is available, otherwise
+    a polling one"""
+    try:
+        return InotifyWatcher(root)
+    except (OSError, AttributeError) as e:
+        log.info("inotify isn't available (%s), polling %s", e, root)
+        return PollingWatcher(root)
@@ -1,110 +1,193 @@
 from __future__ import print_function
 
+# Only light modules are imported here, as every invoke run (even
+# --list or update_nightly without updates) imports this module.
+# Heavy ones (lxml, sqlite, jinja2, requests, toml) are imported by
+# tasks which use them, see startup_budget
 from datetime import datetime
-from docset import build_docset
-from docset.rust import templates
-import hashlib
 from invoke import run, task
-import importlib
-from jinja2 import Template
 import os
-import requests
 import shutil
 import sys
-import tarfile
-from tempfile import TemporaryFile, mkdtemp
-import toml
 
 
-def nightly_url(platform):
-    return "http://static.rust-lang.org/dist/rust-docs-nightly-%s.tar.gz" % platform
+DEFAULT_PLATFORM = "x86_64-unknown-linux-gnu"
 
+# Seconds invoke --list may take, it was 0.2 when everything
+# was imported at load and is ~0.08 now
+STARTUP_BUDGET = 0.15
 
-def doc_prefix(platform):
-    return "rust-docs-nightly-%s/rust-docs/share/doc/rust/html" % platform
+# Modules which shouldn't be imported at load of this module
+HEAVY_MODULES = ["lxml", "requests", "jinja2", "toml", "sqlite3", "tarfile",
+                 "multiprocessing", "builder"]
 
 
-def tag_file_name(platform):
-    return ".last-tag-%s" % platform
+def channel_url(channel, platform):
+    return "http://static.rust-lang.org/dist/rust-docs-%s-%s.tar.gz" % (channel, platform,)
 
 
-def tag_from_response(req):
-    """Generates a uniq tag from a response"""
-    return req.headers['etag']
+def nightly_url(platform):
+    return channel_url("nightly", platform)
 
 
-def has_update(url, tag_file):
-    """Checks if tag was changed"""
-    if not os.path.exists(tag_file):
-        return True
-    else:
-        with open(tag_file, "rt") as f:
-            last_tag = f.read().strip()
+def doc_prefix(platform, channel="nightly"):
+    return "rust-docs-%s-%s/rust-docs/share/doc/rust/html" % (channel, platform,)
+
+
+def tag_file_name(platform, channel="nightly"):
+    if channel == "nightly":
+        return ".last-tag-%s" % platform
+    return ".last-tag-%s-%s" % (channel, platform,)
 
-    r = requests.head(url)
-    new_tag = tag_from_response(r)
-    return new_tag != last_tag
 
+def last_tag(tag_file):
+    if not os.path.exists(tag_file):
+        return None
+    with open(tag_file, "rt") as f:
+        return f.read().strip() or None
+
+
+def fetch_and_build(fetcher, url, prefix, tag_file, force, build_fn):
+    """Downloads archive if it was updated and calls build_fn with
+    source of files under prefix, while it is downloaded.
+    Returns False if there were no updates"""
+    from docset.source import TarSource
+    import tarfile
+
+    # Conditional request, nothing is downloaded if tag is the same
+    download = fetcher.open(url, None if force else last_tag(tag_file))
+    if download is None:
+        return False
+
+    # Archive is processed as it is downloaded, without
+    # extracting docs anywhere
+    print("Downloading and building", url)
+    reader = download.reader()
+    try:
+        with tarfile.open(fileobj=reader, mode='r|gz',
+                          bufsize=1024*1024*10) as tar:
+            build_fn(TarSource(tar, prefix))
+    finally:
+        reader.close()
 
-def extract_docs(tar, dest_dir, doc_prefix):
-    """Extracts only documentation files from nightly archive"""
-    for info in tar.getmembers():
-        if info.name.startswith(doc_prefix):
-            rel_path = os.path.relpath(info.name, doc_prefix)
-            dest_path = os.path.join(dest_dir, rel_path)
-            if info.isdir():
-                if not os.path.exists(dest_path):
-                    os.makedirs(dest_path)
-            else:
-                in_file = tar.extractfile(info)
-                with open(dest_path, "wb") as out_file:
-                    out_file.write(in_file.read())
+    download.wait()
+    fetcher.prune(download)
+    if download.etag:
+        with open(tag_file, "w+t") as f:
+            f.write(download.etag)
+    return True
 
 
 @task
-def update_nightly(force=False, out_dir="nightly_out", platform = "x86_64-unknown-linux-gnu"):
-    """Checks for update and re-builds doc if required. Stores new tag"""
-    url = nightly_url(platform)
-    tag_file = tag_file_name(platform)
+def update_nightly(force=False, out_dir="nightly_out", platform=DEFAULT_PLATFORM,
+                   jobs=None, incremental=False, cache_dir=".nightly-cache"):
+    """Checks for update and re-builds doc if required. Stores new tag
 
-    if not force:
-        if not has_update(url, tag_file):
+Archive is downloaded into cache dir, so interrupted download \
+is resumed by the next run"""
+    from docset.fetch import Fetcher
+
+    def build_fn(source):
+        build_with_conf("nightly.toml", source=source, out_dir=out_dir,
+                        jobs=jobs, incremental=incremental)
+
+    try:
+        if not fetch_and_build(Fetcher(cache_dir), nightly_url(platform),
+                               doc_prefix(platform), tag_file_name(platform),
+                               force, build_fn):
             print("No updates available yet")
-            return
+    except:
+        import traceback
+        traceback.print_exc()
+        exit_with(1, "Internal error")
+
+
+def channel_config(config, spec):
+    """Returns config for a channel from [[channels]] list. Docset
+    name, bundle id and out dir are derived from channel name unless
+    given, the rest of [docset] and [feed] is shared"""
+    channel = spec['channel']
+    platform = spec.get('platform', DEFAULT_PLATFORM)
+    suffix = "" if platform == DEFAULT_PLATFORM else "-" + platform
+
+    result = dict((key, dict(value)) for (key, value) in config.items()
+                  if key in ('docset', 'feed'))
+    ds = result['docset']
+    if channel != "nightly":
+        ds['name'] = "Rust %s" % channel.capitalize()
+        ds['bundle_id'] = "%s-%s" % (ds['bundle_id'], channel,)
+    ds['name'] += suffix
+    ds['bundle_id'] += suffix
+    ds['out_dir'] = "%s%s_out" % (channel, suffix,)
+    for key in ('name', 'bundle_id', 'out_dir'):
+        if key in spec:
+            ds[key] = spec[key]
+
+    return {
+        'channel': channel,
+        'url': spec.get('url', channel_url(channel, platform)),
+        'prefix': spec.get('prefix', doc_prefix(platform, channel)),
+        'tag_file': tag_file_name(platform, channel),
+        'config': result,
+    }
+
+
+@task
+def update_channels(force=False, conf="nightly.toml", jobs=None, incremental=False,
+                    cache_dir=".nightly-cache"):
+    """Checks for updates of all channels in conf and re-builds
+docs of updated ones concurrently
+
+Channels are listed as [[channels]] with channel and optional \
+platform, name, bundle_id, out_dir, url and prefix. All builds \
+share a single worker pool and identical pages are processed \
+only once. Every channel gets its own docset and feed"""
+    from docset import create_pool
+    from docset.fetch import Fetcher
+    import threading
+
+    root_dir = os.path.dirname(os.path.abspath(conf))
+    config = read_conf(conf)
+    ds = config['docset']
+    if incremental:
+        ds['incremental'] = True
+
+    channels = [channel_config(config, spec) for spec in
+                config.get('channels', [{'channel': "nightly"}])]
 
-    r = requests.get(url, stream=True)
-    with TemporaryFile("w+b") as temp_file:
-        print("Downloading", url)
-        for chunk in r.iter_content(1024*1024*10):
-            temp_file.write(chunk)
+    pool = create_pool(int(jobs if jobs is not None else ds.get('jobs', 0)),
+                       {ds['type']: rules_for_type(ds['type'])})
+    shared = {}
+    failed = []
+
+    def update(channel):
+        def build_fn(source):
+            build_in_dir(root_dir, channel['config'], source=source,
+                         pool=pool, shared=shared)
 
-        temp_dir = mkdtemp()
         try:
-            print("Extracting to", temp_dir)
-            temp_file.seek(0)
-            with tarfile.open(fileobj=temp_file, mode='r:gz',
-                              bufsize=1024*1024*10) as tar:
-                extract_docs(tar, temp_dir, doc_prefix(platform))
-
-            print("Building docset")
-            build(doc_dir=temp_dir, out_dir=out_dir, conf="nightly.toml")
-
-            with open(tag_file, "w+t") as f:
-                f.write(tag_from_response(r))
-        except:
+            if not fetch_and_build(Fetcher(cache_dir), channel['url'], channel['prefix'],
+                                   channel['tag_file'], force, build_fn):
+                print("No updates available yet for", channel['channel'])
+        except BaseException:
             import traceback
             traceback.print_exc()
-            exit_with(1, "Internal error")
-        finally:
-            shutil.rmtree(temp_dir)
-
+            failed.append(channel['channel'])
 
-def mod_with_name(name, error_fmt):
+    threads = [threading.Thread(target=update, args=(channel,))
+               for channel in channels]
     try:
-        return importlib.import_module(name)
-    except ImportError as e:
-        print(error_fmt % {'name': name})
-        sys.exit(2)
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+    finally:
+        pool.close()
+        pool.join()
+
+    if failed:
+        exit_with(1, "Failed to update %s" % ", ".join(failed))
+
 
 
 def ensure_abs(path, prefix):
@@ -153,6 +236,8 @@ def validate_config(cfg):
 
 
 def template_from(info, key, prefix_path, default):
+    from jinja2 import Template
+
     if not key in info:
         data = default
     else:
@@ -182,7 +267,22 @@ def warn(message):
     sys.stdout.flush()
 
 
-def build_in_dir(root_dir, config, doc_dir = None, out_dir = None):
+def rules_for_type(ty):
+    from docset import backends
+
+    try:
+        return backends.get(ty).table
+    except backends.BackendError as e:
+        exit_with(2, str(e))
+
+
+def build_in_dir(root_dir, config, doc_dir = None, out_dir = None, source = None,
+                 pool = None, shared = None):
+    from docset import build_docset
+    from docset.delta import DeltaFeed, DEFAULT_KEEP as DEFAULT_DELTA_KEEP
+    from docset.package import Packager
+    from docset.rust import templates
+
     ds = config['docset']
     if not 'version' in ds:
         def_version = "0.1"
@@ -202,12 +302,13 @@ def build_in_dir(root_dir, config, doc_dir = None, out_dir = None):
     if 'icon' in ds:
         ds['icon'] = ensure_abs(ds['icon'], root_dir)
 
-    parts = ds['type'].split(":")
-    if len(parts) == 1:
-        parts.append("default")
+    if 'profile_trace' in ds:
+        ds['profile_trace'] = ensure_abs(ds['profile_trace'], root_dir)
 
-    ty_mod = mod_with_name(parts[0], "Failed to import docset type specs: %(name)s")
-    rules = ty_mod.__getattribute__(parts[1])
+    if 'cache_dir' in ds:
+        ds['cache_dir'] = ensure_abs(ds['cache_dir'], root_dir)
+
+    rules = rules_for_type(ds['type'])
 
     warns = {}
     if not doc_dir:
@@ -228,43 +329,98 @@ def build_in_dir(root_dir, config, doc_dir = None, out_dir = None):
     out_dir = os.path.abspath(out_dir)
 
     # Have to delay to get full path
-    if 'doc_dir' in warns:
+    if 'doc_dir' in warns and not source:
         warn("doc_dir wasn't specified, defaulting to %s" % doc_dir)
 
     if 'out_dir' in warns:
         warn("out_dir wasn't specified, defaulting to %s" % out_dir)
 
     if os.path.exists(out_dir):
-        if os.path.isdir(out_dir):
-            shutil.rmtree(out_dir)
-        else:
+        if not os.path.isdir(out_dir):
             exit_with(1, "Output dir points to a file!\n")
+        # Incremental build reuses previous output
+        elif not ds.get('incremental', False):
+            shutil.rmtree(out_dir)
 
-    os.makedirs(out_dir)
-
-    build_docset(ds, rules, doc_dir, out_dir)
+    if not os.path.exists(out_dir):
+        os.makedirs(out_dir)
 
+    packager = None
     if 'feed' in config:
         feed = config['feed']
-        template = template_from(ds, 'template', root_dir, templates.FEED_XML)
-
         TGZ_TEMP = os.path.join(out_dir, "%s.tar.gz" % ds['name'])
         DOCSET_DIR = "%s.docset" % ds['name']
-        DOC_DIR = os.path.join(out_dir, DOCSET_DIR)
+        # Files are packed as soon as they're built
+        packager = Packager(TGZ_TEMP, os.path.join(out_dir, DOCSET_DIR), DOCSET_DIR,
+                            int(feed.get('gzip_threads', 0)),
+                            int(feed.get('gzip_level', 9)))
 
-        with tarfile.open(TGZ_TEMP, "w:gz", bufsize=1024*1024*10) as tar:
-            tar.add(DOC_DIR, arcname = DOCSET_DIR)
+    try:
+        stats = build_docset(ds, rules, source or doc_dir, out_dir,
+                             packager.add if packager else None, pool, shared)
+    except:
+        if packager:
+            packager.abort()
+        raise
+
+    index_stats = stats['index']
+    print("Indexed %d rows in %.2fs (%.0f rows/s), buffer peak %d KB, "
+          "peak RSS of build process %d KB" %
+          (index_stats['rows'], index_stats['seconds'],
+           index_stats['rows_per_sec'], index_stats['memory'] / 1024,
+           stats['peak_rss'],))
+    if 'queue_peak' in stats:
+        print("Scheduled files for workers biggest first, at most %d in flight" %
+              stats['queue_peak'])
+    counters = stats['counters']
+    if 'skipped_parses' in counters:
+        print("Skipped parsing of %d HTML pages out of %d" %
+              (counters['skipped_parses'],
+               counters['skipped_parses'] + counters.get('parses', 0),))
+
+    if 'streamed_parses' in counters:
+        print("Streamed %d big HTML pages without building a tree" %
+              counters['streamed_parses'])
+
+    if 'cache' in stats:
+        print("Parse cache: %d hits, %d misses, %d entries (%d bytes), %d evicted" %
+              (counters.get('cache_hits', 0), counters.get('cache_misses', 0),
+               stats['cache']['entries'], stats['cache']['size'],
+               stats['cache']['evicted'],))
+
+    if 'shared_pages' in counters:
+        print("Reused %d pages built for other docsets" % counters['shared_pages'])
+
+    if 'dedup' in stats:
+        dedup_stats = stats['dedup']
+        print("Deduplicated %d of %d files, saved %d bytes" %
+              (dedup_stats['duplicates'], dedup_stats['files'],
+               dedup_stats['bytes_saved'],))
+
+    if 'links' in stats:
+        links_stats = stats['links']
+        print("Checked %d index paths and %d links: %d broken paths, %d broken links" %
+              (links_stats['paths'], links_stats['links'],
+               links_stats['broken_paths'], links_stats['broken_links'],))
+        print("\n".join(links_stats['examples']))
+
+    if 'rules' in stats:
+        print("Rule hits:")
+        print("\n".join(stats['rules']))
+
+    if 'profile' in stats:
+        print("Profile:")
+        print("\n".join(stats['profile']))
+
+    if packager:
+        template = template_from(ds, 'template', root_dir, templates.FEED_XML)
 
-        hash = hashlib.sha1()
-        with open(TGZ_TEMP) as f:
-            while True:
-                chunk = f.read(1024*1024*5)
-                if not chunk:
-                    break
-                else:
-                    hash.update(chunk)
+        package_stats = packager.close()
+        print("Packed %d files and %d links into %d bytes" %
+              (package_stats['files'], package_stats['links'],
+               package_stats['size'],))
 
-        sha = hash.hexdigest()
+        sha = package_stats['sha']
         TGZ_NAME = "%s-%s.tgz" % (ds['name'], sha[:8],)
         TGZ = os.path.join(out_dir, TGZ_NAME)
 
@@ -284,30 +440,250 @@ def build_in_dir(root_dir, config, doc_dir = None, out_dir = None):
 
         os.rename(TGZ_TEMP, TGZ)
 
-        if 'upload_cmd' in feed:
-            run('"%s" "%s" "%s"' % (feed['upload_cmd'], TGZ, feed_xml_path,))
-
+        upload_args = [TGZ, feed_xml_path]
+        if 'delta_dir' in feed:
+            deltas = DeltaFeed(ensure_abs(feed['delta_dir'], root_dir), ds['name'],
+                               int(feed.get('delta_keep', DEFAULT_DELTA_KEEP)))
+            delta_stats = deltas.publish(os.path.join(out_dir, DOCSET_DIR), sha,
+                                         packager.hashes, TGZ_NAME, package_stats['size'])
+            upload_args.append(deltas.chain_path)
+            if delta_stats and 'unchanged' in delta_stats:
+                print("No changes since %s, delta isn't published" %
+                      delta_stats['unchanged'][:8])
+            elif delta_stats:
+                print("Delta from %s: %d added, %d modified, %d removed files, "
+                      "%d rows added, %d removed, %d bytes (%.1f%% of full archive) in %.2fs" %
+                      (delta_stats['file'], delta_stats['added'], delta_stats['modified'],
+                       delta_stats['removed'], delta_stats['rows_added'],
+                       delta_stats['rows_removed'], delta_stats['size'],
+                       100.0 * delta_stats['size'] / delta_stats['full_size'],
+                       delta_stats['seconds'],))
+                upload_args.append(delta_stats['path'])
 
-@task
-def build(doc_dir=None, out_dir=None, conf="docset.toml"):
-    """Builds a docset from doc_dir using settings.
-Command line arguments to doc_dir and out_dir override \
-corresponding conf values.
+        if 'upload_cmd' in feed:
+            run(" ".join('"%s"' % arg for arg in [feed['upload_cmd']] + upload_args))
 
-Warning: out dir is cleaned before"""
-    conf = os.path.abspath(conf)
 
+def read_conf(conf):
     if not os.path.exists(conf):
         exit_with(1, "There is no configuration at path %s" % conf)
 
+    import toml
     with open(conf) as cf:
         config = toml.loads(cf.read())
 
     errors = validate_config(config)
     if errors:
         exit_with(1, errors)
+    return config
 
-    build_in_dir(os.path.dirname(conf), config, doc_dir, out_dir)
+
+def build_with_conf(conf, doc_dir=None, out_dir=None, jobs=None,
+                    incremental=False, source=None, profile=False):
+    conf = os.path.abspath(conf)
+    config = read_conf(conf)
+
+    if jobs is not None:
+        config['docset']['jobs'] = int(jobs)
+
+    if incremental:
+        config['docset']['incremental'] = True
+
+    if profile:
+        config['docset']['profile'] = True
+
+    build_in_dir(os.path.dirname(conf), config, doc_dir, out_dir, source)
+
+
+@task
+def build(doc_dir=None, out_dir=None, conf="docset.toml", jobs=None,
+          incremental=False, profile=False):
+    """Builds a docset from doc_dir using settings.
+Command line arguments to doc_dir, out_dir and jobs override \
+corresponding conf values.
+
+Warning: out dir is cleaned before unless build is incremental"""
+    build_with_conf(conf, doc_dir, out_dir, jobs, incremental, profile=profile)
+
+
+@task
+def bench(crates=4, modules=4, items=8, seed=1, jobs=1, repeat=1,
+          corpus=None, output=None, fulltext=False):
+    """Benchmarks build on a synthetic rustdoc corpus
+
+Corpus is generated into a temp dir unless corpus dir is given. \
+If it is given, corpus is generated only if dir doesn't exist, so \
+it could be reused between runs. Results could be saved as JSON \
+with output. With fulltext docset is built with and without \
+full-text search to measure its overhead and query latency."""
+    from docset import bench as bench_mod
+    from tempfile import mkdtemp
+
+    temp_dir = None
+    if not corpus:
+        temp_dir = mkdtemp(prefix="docset-bench")
+        corpus = temp_dir
+
+    try:
+        if temp_dir or not os.path.exists(corpus):
+            print("Generating corpus in", corpus)
+            gen = bench_mod.generate_corpus(corpus, crates, modules, items, seed)
+            print("Generated %d files, %d bytes" % (gen.files, gen.bytes,))
+
+        ds_rules = rules_for_type("docset.rust:nightly")
+        result = bench_mod.run_bench({'jobs': jobs}, ds_rules, corpus, repeat)
+        if fulltext:
+            without = result
+            result = bench_mod.run_bench({'jobs': jobs, 'fulltext': True},
+                                         ds_rules, corpus, repeat)
+            result['fulltext']['overhead'] = result['wall_time'] - without['wall_time']
+        result['corpus'] = {'crates': crates, 'modules': modules,
+                            'items': items, 'seed': seed}
+    finally:
+        if temp_dir:
+            shutil.rmtree(temp_dir)
+
+    print("Files:       %d" % result['files'])
+    print("Wall time:   %.2fs" % result['wall_time'])
+    print("Files/s:     %.1f" % result['files_per_sec'])
+    print("Peak RSS:    %d KB (workers %d KB)" % (result['peak_rss_kb'],
+                                                 result['peak_children_rss_kb'],))
+    print("Index rows:  %d" % result['index_rows'])
+    print("Index buffer: %d KB" % (result['stats']['index']['memory'] / 1024,))
+    if 'fulltext' in result:
+        ft = result['fulltext']
+        print("Full-text:   %d pages, +%.2fs build (%.0f%%), query p50 %.2f ms, p99 %.2f ms" %
+              (ft['pages'], ft['overhead'],
+               100.0 * ft['overhead'] / (result['wall_time'] - ft['overhead']),
+               ft['p50_ms'], ft['p99_ms'],))
+
+    if output:
+        bench_mod.save_result(result, output)
+
+
+def index_path_of(path):
+    """Accepts path of docset or of its docSet.dsidx"""
+    if os.path.isdir(path):
+        return os.path.join(path, "Contents", "Resources", "docSet.dsidx")
+    return path
+
+
+@task
+def query(index, text=None, mode="prefix", types=None, limit=20, queries=None,
+          repeat=1):
+    """Looks up symbols in a built docset
+
+index is a path of .docset or of its docSet.dsidx. Mode is exact, \
+prefix or fuzzy, types is a comma separated list of Dash types. \
+Rows are printed as name, type and path separated by tabs. \
+With queries, a file with a query per line (optionally prefixed \
+with mode and a tab), queries are run repeat times and latency \
+is printed instead."""
+    from docset.query import QueryIndex
+
+    path = index_path_of(index)
+    if not os.path.exists(path):
+        exit_with(1, "There is no index at path %s" % path)
+
+    types = [ty.strip() for ty in types.split(",")] if types else None
+    idx = QueryIndex(path)
+    try:
+        if queries:
+            with open(queries) as f:
+                query_set = [line.rstrip("\n").split("\t", 1) for line in f
+                             if line.strip()]
+            query_set = [q if len(q) == 2 else [mode] + q for q in query_set]
+
+            for i in range(max(1, int(repeat))):
+                for (query_mode, query_text) in query_set:
+                    idx.search(query_text, query_mode, types, int(limit))
+                if i == 0:
+                    cold = idx.stats()
+
+            stats = idx.stats()
+            print("Queries:     %d (%d per pass)" % (stats['queries'], cold['queries'],))
+            print("Cold:        p50 %.3f ms, p99 %.3f ms" % (cold['p50_ms'], cold['p99_ms'],))
+            print("All:         p50 %.3f ms, p99 %.3f ms, cache hit rate %.0f%%" %
+                  (stats['p50_ms'], stats['p99_ms'], stats['cache_hit_rate'] * 100,))
+        elif text:
+            for row in idx.search(text, mode, types, int(limit)):
+                print(u"\t".join(row).encode("utf-8"))
+        else:
+            exit_with(1, "Either text or queries is required")
+    except ValueError as e:
+        exit_with(1, str(e))
+    finally:
+        idx.close()
+
+
+@task
+def apply_deltas(docset, chain, since):
+    """Updates an extracted docset with published deltas
+
+docset is a path of .docset dir, chain is a path of downloaded \
+<name>.deltas.json with delta archives next to it and since is \
+a version (SHA1 of full archive) docset was installed from."""
+    from docset.delta import DeltaError, apply_archive, chain_path
+    import json
+
+    with open(chain) as f:
+        chain_data = json.load(f)
+
+    matches = [version for version in
+               set([d['from'] for d in chain_data['deltas']] + [chain_data['latest']])
+               if version.startswith(since)]
+    if len(matches) != 1:
+        exit_with(1, "Version %s isn't in chain, full archive %s is required" %
+                  (since, chain_data['full'],))
+    deltas = chain_path(chain_data, matches[0])
+    if deltas is None:
+        exit_with(1, "There is no path from %s to the latest version, "
+                  "full archive %s is required" % (since, chain_data['full'],))
+
+    total = 0.0
+    for delta in deltas:
+        try:
+            stats = apply_archive(docset, os.path.join(os.path.dirname(chain),
+                                                       os.path.basename(delta['file'])),
+                                  delta.get('sha1'))
+        except DeltaError as e:
+            exit_with(1, str(e))
+        total += stats['seconds']
+        print("Applied %s: %d files written, %d removed, %d rows in %.2fs" %
+              (delta['file'], stats['files'], stats['removed'], stats['rows'],
+               stats['seconds'],))
+    print("Updated to %s in %.2fs" % (chain_data['latest'], total,))
+
+
+@task
+def startup_budget(budget=STARTUP_BUDGET, runs=5):
+    """Checks that startup stays light
+
+Fails if loading tasks imports any of heavy modules or if the \
+fastest of runs of invoke --list takes more than budget seconds."""
+    import subprocess
+    import time
+
+    root_dir = os.path.dirname(os.path.abspath(__file__))
+    loaded = subprocess.check_output(
+        [sys.executable, "-c",
+         "import sys, tasks; print(' '.join(m for m in %r if m in sys.modules))" %
+         HEAVY_MODULES], cwd=root_dir).split()
+
+    times = []
+    with open(os.devnull, "w") as devnull:
+        for _ in range(max(1, int(runs))):
+            start = time.time()
+            subprocess.check_call([sys.executable, "-c",
+                                   "from invoke.cli import main; main()", "--list"],
+                                  cwd=root_dir, stdout=devnull)
+            times.append(time.time() - start)
+
+    print("invoke --list: %.3fs (budget %.3fs)" % (min(times), float(budget),))
+    if loaded:
+        exit_with(1, "Heavy modules are imported at startup: %s" % ", ".join(loaded))
+    if min(times) > float(budget):
+        exit_with(1, "Startup is over budget")
 
 
 def cargo_result(args):
@@ -324,18 +700,24 @@ def cargo_result(args):
 
 
 @task
-def cargo_doc(feed_base_url = None):
+def cargo_doc(feed_base_url = None, watch = False, debounce = None):
     """Builds docset for cargo project
 
 If feed base url is present also generates a feed file. \
 Base url isn't checked, so it could be a marker, which will be \
-processed later by other tools like sed."""
+processed later by other tools like sed.
+
+With watch docset is kept up to date with target/doc: after \
+cargo doc changes it (and debounce seconds pass), changed pages \
+are processed again and index is updated in place (debounce \
+defaults to 0.5)."""
     proj_loc = cargo_result(["locate-project"])
     proj_root = os.path.dirname(proj_loc["root"])
     manifest = cargo_result(["read-manifest", "--manifest-path=%s" % proj_root])
 
     docset_dir = os.path.join(proj_root, "target", "docset")
-    shutil.rmtree(docset_dir, True)
+    if not watch:
+        shutil.rmtree(docset_dir, True)
 
     ds = {
         "name": manifest["name"],
@@ -349,7 +731,35 @@ processed later by other tools like sed."""
 
     config = {"docset": ds}
 
-    if feed_base_url:
+    if feed_base_url and not watch:
         config["feed"] = {"base_url": feed_base_url}
 
+    if watch:
+        # Previous docset is reused, so watch starts quickly
+        ds["incremental"] = True
+
     build_in_dir(proj_root, config)
+
+    if watch:
+        watch_docset(ds, rules_for_type(ds["type"]), ds["doc_dir"], ds["out_dir"],
+                     debounce)
+
+
+def watch_docset(ds, rules, doc_dir, out_dir, debounce):
+    """Applies changes of doc_dir to docset until interrupted"""
+    from docset import LiveDocset
+    from docset.watch import create_watcher, DEFAULT_DEBOUNCE
+
+    debounce = DEFAULT_DEBOUNCE if debounce is None else float(debounce)
+    live = LiveDocset(ds, rules, doc_dir, out_dir)
+    watcher = create_watcher(doc_dir)
+    print("Watching %s for changes, press Ctrl+C to stop" % doc_dir)
+    try:
+        for changes in watcher.batches(debounce):
+            stats = live.update(changes)
+            print("Updated %d files: %d rows added, %d removed" %
+                  (stats['files'], stats['added'], stats['removed'],))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        watcher.close()